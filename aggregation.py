@@ -0,0 +1,166 @@
+# Rolling aggregation of power and energy values
+#
+# Every window keeps its samples in fixed size array('d') ring buffers. Sum, minimum and maximum
+# are updated incrementally on every sample (monotonic queues for min/max), so adding a sample
+# costs the same for a 1 s and a 15 min window.
+
+from array import array
+from collections import deque
+
+# (name used in the dbus path, length in seconds)
+DEFAULT_WINDOWS = [('1s', 1), ('1min', 60), ('15min', 900)]
+# highest expected datagram rate in Hz, used to size the ring buffers (SHM2.0 sends with 5 Hz)
+MAX_RATE = 10
+
+# value name -> dbus path below /Ac/Aggregate/<window>
+POWER_CHANNELS = {
+    'power':    'Power',
+    'L1_power': 'L1/Power',
+    'L2_power': 'L2/Power',
+    'L3_power': 'L3/Power',
+}
+ENERGY_CHANNELS = {
+    'forward': 'Energy/Forward',
+    'reverse': 'Energy/Reverse',
+}
+
+
+class RollingWindow(object):
+
+    def __init__(self, seconds, capacity):
+        self.seconds = seconds
+        self._capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._head = 0
+        self._count = 0
+        self._sum = 0.0
+        # sequence number of the oldest sample and monotonic queues of (sequence, value)
+        self._first = 0
+        self._next = 0
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, timestamp, value):
+        times = self._times
+        values = self._values
+        capacity = self._capacity
+
+        # drop samples which left the window
+        while self._count and (self._count == capacity or timestamp - times[self._head] >= self.seconds):
+            self._sum -= values[self._head]
+            self._head += 1
+            if self._head == capacity:
+                self._head = 0
+            self._count -= 1
+            self._first += 1
+
+        tail = self._head + self._count
+        if tail >= capacity:
+            tail -= capacity
+        times[tail] = timestamp
+        values[tail] = value
+        self._count += 1
+        self._sum += value
+
+        if tail == 0:
+            # recalculate the sum once per turn of the ring so rounding errors do not add up
+            self._sum = sum(self.values())
+
+        sequence = self._next
+        self._next += 1
+
+        first = self._first
+        queue = self._min
+        while queue and queue[-1][1] >= value:
+            queue.pop()
+        queue.append((sequence, value))
+        while queue[0][0] < first:
+            queue.popleft()
+
+        queue = self._max
+        while queue and queue[-1][1] <= value:
+            queue.pop()
+        queue.append((sequence, value))
+        while queue[0][0] < first:
+            queue.popleft()
+
+    def values(self):
+        for i in range(self._count):
+            yield self._values[(self._head + i) % self._capacity]
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count else 0
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._count else 0
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._count else 0
+
+    @property
+    def first(self):
+        return self._values[self._head] if self._count else 0
+
+    @property
+    def last(self):
+        if not self._count:
+            return 0
+        return self._values[(self._head + self._count - 1) % self._capacity]
+
+
+class PowerAggregator(object):
+
+    def __init__(self, windows=DEFAULT_WINDOWS, rate=MAX_RATE):
+        self._power = []
+        self._energy = []
+        for name, seconds in windows:
+            capacity = int(seconds * rate) + 1
+            prefix = '/Ac/Aggregate/%s/' % name
+            self._power.append([(RollingWindow(seconds, capacity), prefix + path + '/Mean', prefix + path + '/Min', prefix + path + '/Max')
+                                for path in POWER_CHANNELS.values()])
+            self._energy.append([(RollingWindow(seconds, capacity), prefix + path) for path in ENERGY_CHANNELS.values()])
+
+        self._power_names = list(POWER_CHANNELS)
+        self._energy_names = list(ENERGY_CHANNELS)
+
+    def add(self, timestamp, values):
+        # values has to contain all names of POWER_CHANNELS and ENERGY_CHANNELS
+        power = [values[name] for name in self._power_names]
+        energy = [values[name] for name in self._energy_names]
+        for channels in self._power:
+            for channel, value in zip(channels, power):
+                channel[0].add(timestamp, value)
+        for channels in self._energy:
+            for channel, value in zip(channels, energy):
+                channel[0].add(timestamp, value)
+
+    def paths(self):
+        for channels in self._power:
+            for window, mean, minimum, maximum in channels:
+                yield mean
+                yield minimum
+                yield maximum
+        for channels in self._energy:
+            for window, path in channels:
+                yield path
+
+    def results(self):
+        # list of (path, value): mean, min and max power and the energy delta of every window
+        results = []
+        for channels in self._power:
+            for window, mean, minimum, maximum in channels:
+                results.append((mean, round(window.mean, 2)))
+                results.append((minimum, window.min))
+                results.append((maximum, window.max))
+        for channels in self._energy:
+            for window, path in channels:
+                results.append((path, round(window.last - window.first, 3)))
+        return results
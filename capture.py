@@ -0,0 +1,52 @@
+# Speedwire capture files
+#
+# Append-only file of received datagrams, written by speedwire_test.py --record or by the
+# service with RECORD_FILE set, and read by speedwire_replay.py and speedwire_bench.py.
+#
+# Layout: 8 byte magic, then one record per datagram:
+#   receive time (float64, seconds since epoch), datagram length (uint16), datagram
+
+import struct
+
+MAGIC = b'SWCAP\x00\x01\x00'
+_RECORD = struct.Struct('<dH')
+
+
+class CaptureWriter(object):
+
+    def __init__(self, filename):
+        self._file = open(filename, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, timestamp, data):
+        self._file.write(_RECORD.pack(timestamp, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def is_capture(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_capture(filename):
+    # yields (timestamp, datagram), a truncated last record is ignored
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a Speedwire capture file' % filename)
+
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, data
@@ -13,45 +13,127 @@ Used https://github.com/victronenergy/velib_python/blob/master/dbusdummyservice.
 Reading information from the SMA-EM Smart Meter or Sunny HM2.0 via Speedwire Broadcast puts the info on dbus.
 
 """
+import time
+# monotonic time before the imports, for the startup statistics
+started = time.monotonic()
+
 from gi.repository import GLib
 from vedbus import VeDbusService
-import socket
-import struct
-import platform
 import argparse
 import logging
-from logging.handlers import RotatingFileHandler
 import sys
 import os
-import threading
+import signal
+import dbus
+from speedwire import SpeedwireDecoder, parse_header, load_channels, MIN_LENGTH, DEFAULT_CHANNELS_FILE
+from derived import DerivedStage, DERIVED_METRICS, reversed_metrics, swap_direction
+from publisher import DbusPublisher, DEFAULT_DEADBANDS
+from scheduler import PublishScheduler, DEFAULT_INTERVALS
+from aggregation import PowerAggregator, DEFAULT_WINDOWS
+from stats import ReceiverStats, ServiceStats, StartupStats
+import multicast
+
+# multicast group, interface, receive buffer and source filter are set in socket.json or on the
+# command line, see multicast.py and python3 dbus-sma-smartmeter.py --help
 
-MULTICAST_IP = "239.12.255.254"
-MULTICAST_PORT = 9522
 # set serial from used energiemeter if more then one in your network otherwise set to 0
 EM_SERIAL = 0
+# create one dbus service per SMA meter found on the network instead of one grid meter
+AUTO_DISCOVERY = False
+# role ('grid', 'pvinverter' or 'acload'), device instance and position (pvinverter only) per
+# serial for auto discovery. Meters which are not listed get DEFAULT_ROLE, role None ignores a meter.
+METERS = {
+    # 1900000001: {'role': 'grid', 'deviceinstance': 0},
+    # 1900000002: {'role': 'pvinverter', 'deviceinstance': 1, 'position': 0},
+}
+DEFAULT_ROLE = 'grid'
+# meters without 'deviceinstance' get one derived from their serial in this range (first, last),
+# so VRM keeps their history apart across restarts
+AUTO_DEVICEINSTANCES = (40, 239)
+# sign of the power per role. A meter of a producer sees the production as export, -1 publishes
+# it as positive /Ac/Power and the export counter as /Ac/Energy/Forward. 'sign' in METERS
+# overrides it per meter.
+ROLE_SIGNS = {'grid': 1, 'acload': 1, 'pvinverter': -1}
+# OBIS channel map, channels can be enabled, disabled or limited to SUSy-IDs there
+CHANNELS_FILE = DEFAULT_CHANNELS_FILE
+# values are only published if they changed more than the deadband, see publisher.py
+DEADBANDS = DEFAULT_DEADBANDS
+# publish interval per path in seconds, 0 publishes with every datagram, see scheduler.py
+PUBLISH_INTERVALS = DEFAULT_INTERVALS
+# publish mean, min and max power and the energy delta of rolling windows below /Ac/Aggregate
+AGGREGATION = True
+AGGREGATION_WINDOWS = DEFAULT_WINDOWS
+# interval to publish the statistics below /Mgmt/Stats in seconds, kill -USR1 writes them to the log
+STATS_INTERVAL = 10
+# a meter is disconnected after this many seconds without datagram
+SILENCE_TIMEOUT = 10
+# paths set to invalid when the meter is disconnected
+SILENCE_CLEARED_PATHS = ['/Ac/Power', '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power']
+# first delay between attempts to join the multicast group again, doubled up to the maximum
+RECONNECT_DELAY = 10
+RECONNECT_MAX_DELAY = 300
+# store the history of every meter in segment files below this directory, None to disable.
+# Query it with history.py, e.g. python3 history.py /data/dbus-sma-smartmeter/history/<serial> --list
+HISTORY_DIR = None
+HISTORY_CHANNELS = ['power', 'L1_power', 'L2_power', 'L3_power', 'pregardcounter', 'surpluscounter',
+                    'L1_voltage', 'L2_voltage', 'L3_voltage', 'frequency']
+# interval to sync the history files to the SD card in seconds
+HISTORY_FLUSH_INTERVAL = 300
+# fan out the values of every datagram to local consumers, see sinks.py, e.g.
+#   {'type': 'udp', 'host': '127.0.0.1', 'port': 9523}
+#   {'type': 'mqtt', 'host': 'localhost', 'topic': 'smaem'}
+#   {'type': 'modbus', 'port': 5020}
+SINKS = []
+# append all received datagrams to this capture file for speedwire_replay.py, None to disable
+RECORD_FILE = None
+# the log file is opened after the first published reading, at the latest after LOG_FILE_DELAY seconds
+LOG_FILE = '/var/log/dbus-sma-smartmeter/current.log'
+LOG_FILE_DELAY = 60
 
 # our own packages
 sys.path.insert(1, os.path.join(
     os.path.dirname(__file__), '../ext/velib_python'))
 
-os.makedirs('/var/log/dbus-sma-smartmeter', exist_ok=True) 
-logging.basicConfig(
-    format = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-    datefmt = '%Y-%m-%d %H:%M:%S',
-    level = logging.DEBUG,
-    handlers = [
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler = RotatingFileHandler('/var/log/dbus-sma-smartmeter/current.log', maxBytes=200000, backupCount=5)
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+log_file_handler = None
+
+def setup_logging():
+    logging.basicConfig(
+        format = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt = '%Y-%m-%d %H:%M:%S',
+        level = logging.DEBUG,
+        handlers = [
+            logging.StreamHandler()
+        ]
+    )
+
+def add_log_file():
+    # deferred, creating and rotating the log file must not delay the first reading
+    global log_file_handler
+    if log_file_handler is None:
+        from logging.handlers import RotatingFileHandler
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        log_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=200000, backupCount=5)
+        log_file_handler.setLevel(logging.DEBUG)
+        log_file_handler.setFormatter(formatter)
+        logger.addHandler(log_file_handler)
+    return False
+
+# startup phases and time to the first reading
+startup = StartupStats(started)
+startup.mark('Imports')
+# counters of the socket, shared by all meters
+receiver_stats = ReceiverStats()
+# output sinks of SINKS, shared by all meters
+sinks = []
+
+def dbusconnection():
+    # every service needs its own connection when more than one meter is published
+    return dbus.SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus(private=True)
 
 class DbusSMAEMService(object):
-    def __init__(self, servicename, deviceinstance, productname='SMA-EM Speedwire Bridge', connection='SMA-EM Service'):
+    def __init__(self, servicename, deviceinstance, productname='SMA-EM Speedwire Bridge', connection='SMA-EM Service', role='grid', position=0, sign=1):
 
         self._protocol_points = {
 			'SMASusyID': {'name': 'SMA Device SUSy-ID'                     , 'update': False, 'addr': 18, 'length': 2, 'unit': ''},
@@ -66,42 +148,28 @@ class DbusSMAEMService(object):
             372: {'name' : 'SHM2.0',   'serial' : 0, 'sw' : '', 'active' : False},
         }
 
-        self._obis_points = {
-            # real values
-            0x00010400: {'name': 'pregard',             'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x00010800: {'name': 'pregardcounter',      'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/Energy/Forward'},
-            0x00020400: {'name': 'surplus',             'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x00020800: {'name': 'surpluscounter',      'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/Energy/Reverse'},
-            0x00200400: {'name': 'L1_voltage',          'length': 4, 'factor': 1/1000,    'unit': 'V',   'value': 0, 'path': '/Ac/L1/Voltage'},
-            0x00340400: {'name': 'L2_voltage',          'length': 4, 'factor': 1/1000,    'unit': 'V',   'value': 0, 'path': '/Ac/L2/Voltage'},
-            0x00480400: {'name': 'L3_voltage',          'length': 4, 'factor': 1/1000,    'unit': 'V',   'value': 0, 'path': '/Ac/L3/Voltage'},
-            0x001F0400: {'name': 'L1_current',          'length': 4, 'factor': 1/1000,    'unit': 'A',   'value': 0, 'path': ''},
-            0x00330400: {'name': 'L2_current',          'length': 4, 'factor': 1/1000,    'unit': 'A',   'value': 0, 'path': ''},
-            0x00470400: {'name': 'L3_current',          'length': 4, 'factor': 1/1000,    'unit': 'A',   'value': 0, 'path': ''},
-            0x00150400: {'name': 'L1_pregard',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x00290400: {'name': 'L2_pregard',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x003D0400: {'name': 'L3_pregard',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x00160400: {'name': 'L1_surplus',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x002a0400: {'name': 'L2_surplus',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x003E0400: {'name': 'L3_surplus',          'length': 4, 'factor': 1/10,      'unit': 'W',   'value': 0, 'path': ''},
-            0x00150800: {'name': 'L1_pregardcounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L1/Energy/Forward'},
-            0x00290800: {'name': 'L2_pregardcounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L2/Energy/Forward'},
-            0x003D0800: {'name': 'L3_pregardcounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L3/Energy/Forward'},
-            0x00160800: {'name': 'L1_surpluscounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L1/Energy/Reverse'},
-            0x002A0800: {'name': 'L2_surpluscounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L2/Energy/Reverse'},
-            0x003E0800: {'name': 'L3_surpluscounter',   'length': 8, 'factor': 1/3600000, 'unit': 'kWh', 'value': 0, 'path': '/Ac/L3/Energy/Reverse'},
-            0x90000000: {'name': 'sw_version_raw',      'length': 4, 'factor': 1,         'unit': '',    'value': 0, 'path': ''},
-            # calculated values
-            0x00000001: {'name': 'power',               'length': 0, 'factor': 1,         'unit': 'W',   'value': 0, 'path': '/Ac/Power'},
-            0x00000002: {'name': 'L1_power',            'length': 0, 'factor': 1,         'unit': 'W',   'value': 0, 'path': '/Ac/L1/Power'},
-            0x00000003: {'name': 'L2_power',            'length': 0, 'factor': 1,         'unit': 'W',   'value': 0, 'path': '/Ac/L2/Power'},
-            0x00000004: {'name': 'L2_power',            'length': 0, 'factor': 1,         'unit': 'W',   'value': 0, 'path': '/Ac/L3/Power'},
-            0x00000005: {'name': 'L1_current',          'length': 0, 'factor': 1,         'unit': 'A',   'value': 0, 'path': '/Ac/L1/Current'},
-            0x00000006: {'name': 'L2_current',          'length': 0, 'factor': 1,         'unit': 'A',   'value': 0, 'path': '/Ac/L2/Current'},
-            0x00000007: {'name': 'L3_current',          'length': 0, 'factor': 1,         'unit': 'A',   'value': 0, 'path': '/Ac/L3/Current'},
-        }
-
-        self._dbusservice = VeDbusService(servicename)
+        # channel map from obis.json, every meter has its own copy for the values
+        self._obis_points = load_channels(CHANNELS_FILE)
+        # names of the energy counters (Forward, Reverse) in the direction of the published power
+        counters = ('pregardcounter', 'surpluscounter')
+        metrics = DERIVED_METRICS
+        if sign < 0:
+            for point in self._obis_points.values():
+                point['path'] = swap_direction(point['path'], 'Forward', 'Reverse')
+            counters = ('surpluscounter', 'pregardcounter')
+            metrics = reversed_metrics()
+
+        # the same points by channel name, channels disabled in obis.json are missing
+        self._channels = {point['name']: point for point in self._obis_points.values()}
+
+        self._servicename = servicename
+        self._decoder = SpeedwireDecoder(self._obis_points)
+        self._derived = DerivedStage(self._obis_points, metrics)
+        if self._derived.skipped:
+            logger.info('Derived values without input channels: %s' % ', '.join(self._derived.skipped))
+
+        # all paths are added before the service is registered, so dbus sees the complete tree at once
+        self._dbusservice = VeDbusService(servicename, bus=dbusconnection(), register=False)
         logger.info('Connected to dbus, DbusSMAEMService class created')
         logger.debug("%s /DeviceInstance = %d" %
                       (servicename, deviceinstance))
@@ -109,7 +177,7 @@ class DbusSMAEMService(object):
         # Create the management objects, as specified in the ccgx dbus-api document
         self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
         self._dbusservice.add_path(
-            '/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
+            '/Mgmt/ProcessVersion', 'Unkown version, and running on Python %d.%d.%d' % sys.version_info[:3])
         self._dbusservice.add_path('/Mgmt/Connection', connection)
 
         # Create the mandatory objects
@@ -121,153 +189,499 @@ class DbusSMAEMService(object):
         self._dbusservice.add_path('/Serial', 0)
         self._dbusservice.add_path('/Connected', 1)
         self._dbusservice.add_path('/UpdateIndex', 0)
-
-        for obis_value in self._obis_points.values():
-            if obis_value['path'] != '':
-                self._dbusservice.add_path(
-                    obis_value['path'], obis_value['value'], writeable=True, onchangecallback=self._handlechangedvalue)
-
-        self._sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._sock.bind(("", MULTICAST_PORT))
-
-        mreq = struct.pack("4sl", socket.inet_aton(
-            MULTICAST_IP), socket.INADDR_ANY)
-        self._sock.setsockopt(
-            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-        threading.Thread(target=self._alive, args=(self._sock,)).start()
-
-    def _alive(self, sock):
-        logger.info('Socket Thread started')
-        while True:
-           self._update(sock.recv(1024))
-
-    def _update(self, data):
-
+        if role == 'pvinverter':
+            self._dbusservice.add_path('/Position', position)
+
+        self._published_points = [point for point in self._obis_points.values() if point['path'] != '']
+        self._published_points.extend(point for point in self._derived.points.values() if point['path'] != '')
+
+        for obis_value in self._published_points:
+            self._dbusservice.add_path(
+                obis_value['path'], obis_value['value'], writeable=True, onchangecallback=self._handlechangedvalue)
+
+        self._aggregator = None
+        if AGGREGATION:
+            self._aggregated_points = {
+                'power':    self._derived.points.get('power'),
+                'L1_power': self._derived.points.get('L1_power'),
+                'L2_power': self._derived.points.get('L2_power'),
+                'L3_power': self._derived.points.get('L3_power'),
+                'forward':  self._channels.get(counters[0]),
+                'reverse':  self._channels.get(counters[1]),
+            }
+            missing = [name for name, point in self._aggregated_points.items() if point is None]
+            if missing:
+                logger.info('No aggregation, input channels are disabled: %s' % ', '.join(missing))
+            else:
+                self._aggregator = PowerAggregator(AGGREGATION_WINDOWS)
+                for path in self._aggregator.paths():
+                    self._dbusservice.add_path(path, 0)
+
+        # only registered paths are cleared, e.g. /Ac/L2/Power is missing if its channels are disabled
+        paths = set(point['path'] for point in self._published_points)
+        if self._aggregator is not None:
+            paths.update(self._aggregator.paths())
+        self._silence_cleared_paths = [path for path in SILENCE_CLEARED_PATHS if path in paths]
+
+        self._publisher = DbusPublisher(self._dbusservice, DEADBANDS)
+        self._scheduler = PublishScheduler(self._publisher, PUBLISH_INTERVALS)
+
+        self._history = None
+        self._history_points = None
+        self._history_failed = False
+        self._sink_points = list(self._obis_points.values()) + list(self._derived.points.values())
+
+        self._stats = ServiceStats()
+        self._last_frame = None
+        self._created = time.monotonic()
+        self._connected = True
+        for path, value in self._stats_values():
+            self._dbusservice.add_path(path, value)
+        GLib.timeout_add_seconds(STATS_INTERVAL, self._publish_stats)
+
+        self._dbusservice.register()
+
+    def _update(self, data, timestamp=None):
+
+        stage = 'Decode'
         try:
-            arrlen = len(data)
-
-            sma = str(data[0:3], 'ascii')
-            #logger.info(sma + ' length: ' + str(arrlen))
-            if sma == 'SMA' and arrlen > 100:
-
-                SMASusyID = int.from_bytes(data[18:20], 'big')
-                SMASerial = int.from_bytes(data[20:24], 'big')
+            header = parse_header(data)
+            if header is not None:
+
+                now = time.monotonic()
+                if self._last_frame is not None:
+                    self._stats.gap.add((now - self._last_frame) * 1000)
+                self._last_frame = now
+
+                if not self._connected:
+                    logger.info('%s is receiving datagrams again' % self._servicename)
+                    self._connected = True
+                    self._publisher.set('/Connected', 1)
+                    # publish all values again
+                    self._publisher.forget()
+                self._stats.frames += 1
+                start = time.perf_counter()
+
+                SMASusyID, SMASerial = header
                 # logger.info('SMASusyID: ' + str(SMASusyID) + ' SMASerial: ' + str(SMASerial))
 
-                # check serialnumber, if not equal end update
-                if EM_SERIAL != 0:
-
-                    if SMASerial != EM_SERIAL:
-                        return True
-
+                # the susy filters of the channels see the real id, unknown devices only share
+                # the hardware entry 0
+                self._decoder.decode(data, SMASusyID, SMASerial)
                 if SMASusyID not in self._hardware:
                     SMASusyID = 0
 
-                if self._hardware[SMASusyID]['active'] == False:
-                    self._hardware[SMASusyID]['serial'] = SMASerial
-                    self._dbusservice['/HardwareVersion'] = self._hardware[SMASusyID]['name']
-                    self._dbusservice['/Serial'] = self._hardware[SMASusyID]['serial']
+                self._derived.update()
 
-                pos = 28
+                if self._aggregator is not None:
+                    self._aggregator.add(now, {name: point['value'] for name, point in self._aggregated_points.items()})
 
-                while (pos < arrlen):
+                decoded = time.perf_counter()
+                self._stats.decode_time.add((decoded - start) * 1e6)
+                stage = 'Publish'
 
-                    # Get obis value as 32 bit number
-                    obis_num = int.from_bytes(data[pos: pos + 4], 'big')
+                # only changed values are sent, all in one ItemsChanged signal with an incremented
+                # UpdateIndex, the scheduler holds back the values which are published by its timers
+                changes = [(obis_value['path'], obis_value['value']) for obis_value in self._published_points]
+                if self._aggregator is not None:
+                    changes.extend(self._aggregator.results())
+                self._scheduler.update(changes)
 
-                    if obis_num not in self._obis_points:
+                self._stats.publish_time.add((time.perf_counter() - decoded) * 1e6)
+                if timestamp is not None:
+                    self._stats.latency.add((time.time() - timestamp) * 1e6)
 
-                        # check for end of message
-                        if obis_num == 0 and pos == arrlen - 4:
-                            break
+                # after dbus, the sinks only queue the snapshot
+                if sinks:
+                    snapshot = {'serial': SMASerial, 'time': time.time(),
+                                'values': {point['name']: point['value'] for point in self._sink_points}}
+                    for sink in sinks:
+                        sink.put(snapshot)
 
-                        # Extract length from obis number, second byte is the length
-                        offset = int.from_bytes(data[pos + 2: pos + 3], 'big')
+                # optional, after dbus and with its own error handling
+                if HISTORY_DIR and not self._history_failed:
+                    self._write_history(SMASerial)
 
-                        # Only 4 or 8 is allowed for offset since all known OBIS values have the length 4 or 8
-                        # Add 4 for the OBIS value itself.
-                        if offset == 4 or offset == 8:
-                            pos += offset + 4
-                        else:
-                            pos += 4 + 4
+                # hardware and firmware are set after the first values are published
+                if self._hardware[SMASusyID]['active'] == False:
+                    self._hardware[SMASusyID]['active'] = True
+                    GLib.idle_add(self._identify, SMASusyID, SMASerial)
+
+                if startup.reading():
+                    logger.info('Startup: %s' % startup.summary())
+                    GLib.idle_add(add_log_file)
+
+        except Exception as e:
+            # count the errors, only the first one of every category is logged
+            self._stats.errors[stage] += 1
+            if self._stats.errors[stage] == 1:
+                logger.warning("Could not read from SMA Energy Meter (%s error): %s" % (stage, e), exc_info=True)
+            try:
+                self._publisher.set('/Ac/Power', 0)
+            except Exception:
+                # dbus is not usable, the error is already counted
+                pass
 
-                        continue
+        return True
 
-                    length = self._obis_points[obis_num]['length']
-                    pos += 4
+    def _identify(self, SMASusyID, SMASerial):
+        self._hardware[SMASusyID]['serial'] = SMASerial
+        self._dbusservice['/HardwareVersion'] = self._hardware[SMASusyID]['name']
+        self._dbusservice['/Serial'] = self._hardware[SMASusyID]['serial']
+
+        # the firmware version stays unknown if its channel is disabled
+        if 'sw_version_raw' in self._channels:
+            swr = self._channels['sw_version_raw']['value']
+            sw = str((swr >> 24) & 0xFF)
+            sw += '.' + str((swr >> 16) & 0xFF)
+            sw += '.' + str((swr >> 8) & 0xFF)
+            sw += '.' + chr(swr & 0xFF)
+            self._hardware[SMASusyID]['sw'] = sw
+            self._dbusservice['/FirmwareVersion'] = self._hardware[SMASusyID]['sw']
+        return False
+
+    def _open_history(self, serial):
+        points = dict(self._channels)
+        points.update(self._derived.points)
+        channels = [name for name in HISTORY_CHANNELS if name in points]
+        self._history_points = [points[name] for name in channels]
+        from history import HistoryWriter
+        self._history = HistoryWriter(os.path.join(HISTORY_DIR, str(serial)), channels)
+        GLib.timeout_add_seconds(HISTORY_FLUSH_INTERVAL, self._flush_history)
+        logger.info('Writing history of %s to %s' % (channels, HISTORY_DIR))
+
+    def _write_history(self, serial):
+        try:
+            if self._history is None:
+                self._open_history(serial)
+            self._history.add(time.time(), [point['value'] for point in self._history_points])
+        except Exception as e:
+            self._disable_history(e)
+
+    def _flush_history(self):
+        # only wakes the worker thread of the history, the fsync does not block the main loop
+        if self._history is None:
+            return False
+        try:
+            self._history.flush()
+        except Exception as e:
+            self._disable_history(e)
+            return False
+        return True
 
-                    # Read obis message value as 32 or 64 bit unsigned int value
-                    val = 0
-                    if length == 4:
-                        val = int.from_bytes(data[pos: pos + length], 'big')
+    def _disable_history(self, error):
+        # a full or read-only /data must not stop the meter, the history is not tried again
+        logger.warning('History of %s disabled: %s' % (self._servicename, error))
+        self._history_failed = True
+        if self._history is not None:
+            try:
+                self._history.close()
+            except Exception:
+                pass
+            self._history = None
+
+    def check_silence(self, now):
+        # called by the watchdog, clears the power values if the meter went quiet
+        last = self._last_frame if self._last_frame is not None else self._created
+        if self._connected and now - last > SILENCE_TIMEOUT:
+            logger.warning('%s: no datagram for %d s, disconnected' % (self._servicename, now - last))
+            self._connected = False
+            self._scheduler.clear()
+            self._publisher.set('/Connected', 0)
+            for path in self._silence_cleared_paths:
+                self._publisher.set(path, None)
+
+    def _stats_values(self):
+        values = receiver_stats.values()
+        values.extend(self._stats.values())
+        values.extend(startup.values())
+        values.append(('/Mgmt/Stats/Published', self._publisher.published))
+        values.append(('/Mgmt/Stats/Suppressed', self._publisher.suppressed))
+        values.append(('/Mgmt/Stats/Decimated', self._scheduler.decimated))
+        for sink in sinks:
+            values.extend(sink.stats())
+        return values
+
+    def _publish_stats(self):
+        # directly in one signal, not through the publisher, which only counts the meter values
+        with self._dbusservice as s:
+            for path, value in self._stats_values():
+                s[path] = value
+        return True
 
-                    elif length == 8:
-                        val = int.from_bytes(data[pos: pos + length], 'big')
+    def log_stats(self):
+        logger.info('Statistics of %s:' % self._servicename)
+        for path, value in self._stats_values():
+            logger.info('  %s = %s' % (path, value))
 
-                    else:
-                        logger.info(
-                            "Only OBIS message length of 4 or 8 is support, current length is" + length)
+    def _handlechangedvalue(self, path, value):
+        logger.debug("someone else updated %s to %s" % (path, value))
+        # publish the meter value again with the next datagram
+        self._publisher.forget(path)
+        return True  # accept the change
 
-                    # Convert raw value to final value
-                    self._obis_points[obis_num]['value'] = round(
-                        val * self._obis_points[obis_num]['factor'], 2)
+class SpeedwireReceiver(object):
+    # one multicast socket for all meters, datagrams are passed to dispatch(serial, data, timestamp)
+    def __init__(self, dispatch, config):
+        self._dispatch = dispatch
+        self._config = config
+        self._recorder = None
+        if RECORD_FILE:
+            from capture import CaptureWriter
+            try:
+                self._recorder = CaptureWriter(RECORD_FILE)
+            except OSError as e:
+                logger.warning('Recording to %s disabled: %s' % (RECORD_FILE, e))
+        self._sock = None
+        self._reader = None
+        self._watch = None
+        # monotonic time of the last SMA datagram and of the moment the watchdog noticed the silence
+        self.last_datagram = time.monotonic()
+        self.silent_since = None
+        self._open()
+
+    def _open(self):
+        self._sock = multicast.open_socket(self._config)
+        # the socket is read from the GLib main loop, no thread is touching the dbus services
+        self._sock.setblocking(False)
+        if self._reader is None:
+            self._reader = multicast.BatchReader(self._sock, self._config, receiver_stats)
+        else:
+            self._reader.reset(self._sock)
+
+        self._watch = GLib.io_add_watch(self._sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._receive)
+        logger.info('Socket watch registered')
+
+    def reconnect(self, recreate):
+        # join the multicast group again, e.g. after an IGMP snooping timeout, or create a new socket
+        group = self._config['group']
+        if self._sock is not None and not recreate:
+            try:
+                multicast.join(self._sock, self._config, leave_first=True)
+                logger.info('Joined multicast group %s again' % group)
+                return
+            except OSError as e:
+                logger.warning('Could not join multicast group %s: %s' % (group, e))
+
+        if self._watch is not None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
 
-                    # Set read address to next obis value
-                    pos += length
+        try:
+            self._open()
+            logger.info('Socket created again')
+        except OSError as e:
+            logger.warning('Could not create socket: %s' % e)
+
+    def _disable_recorder(self, error):
+        # a full or read-only /data must not stop the receiver, the recording is not tried again
+        logger.warning('Recording to %s disabled: %s' % (RECORD_FILE, error))
+        try:
+            self._recorder.close()
+        except OSError:
+            pass
+        self._recorder = None
+
+    def _receive(self, fd, condition):
+        # drain all queued datagrams and only process the newest one of every meter
+        frames = {}
+        for data, address, timestamp in self._reader.read():
+            if self._recorder is not None:
+                try:
+                    self._recorder.write(timestamp, data)
+                except OSError as e:
+                    self._disable_recorder(e)
+
+            if len(data) <= MIN_LENGTH:
+                receiver_stats.rejected['Short'] += 1
+                continue
+
+            header = parse_header(data)
+            if header is None:
+                receiver_stats.rejected['Header'] += 1
+                continue
+
+            if header[1] in frames:
+                receiver_stats.stale += 1
+            frames[header[1]] = (bytes(data), timestamp)
+
+        if self._recorder is not None:
+            try:
+                self._recorder.flush()
+            except OSError as e:
+                self._disable_recorder(e)
+
+        if frames:
+            self.last_datagram = time.monotonic()
+            if self.silent_since is not None:
+                receiver_stats.recovery_time = round(self.last_datagram - self.silent_since, 1)
+                self.silent_since = None
+                logger.info('Receiving datagrams again after %.1f s' % receiver_stats.recovery_time)
+
+        for serial, (data, timestamp) in frames.items():
+            self._dispatch(serial, data, timestamp)
 
-                # calculate the power values
-                self._obis_points[0x00000001]['value'] = round(self._obis_points[0x00010400]['value'] - self._obis_points[0x00020400]['value'], 2)
-                self._obis_points[0x00000002]['value'] = round(self._obis_points[0x00150400]['value'] - self._obis_points[0x00160400]['value'], 2)
-                self._obis_points[0x00000003]['value'] = round(self._obis_points[0x00290400]['value'] - self._obis_points[0x002a0400]['value'], 2)
-                self._obis_points[0x00000004]['value'] = round(self._obis_points[0x003D0400]['value'] - self._obis_points[0x003E0400]['value'], 2)
-                #self._obis_points[0x00000005]['value'] = round((self._obis_points[0x00150400]['value'] - self._obis_points[0x00160400]['value']) / self._obis_points[0x00200400]['value'], 2)
-                #self._obis_points[0x00000006]['value'] = round((self._obis_points[0x00290400]['value'] - self._obis_points[0x002a0400]['value']) / self._obis_points[0x00340400]['value'], 2)
-                #self._obis_points[0x00000007]['value'] = round((self._obis_points[0x003D0400]['value'] - self._obis_points[0x003E0400]['value']) / self._obis_points[0x00480400]['value'], 2)
-                self._obis_points[0x00000005]['value'] = -self._obis_points[0x001F0400]['value'] if self._obis_points[0x00160400]['value'] > 0 else self._obis_points[0x001F0400]['value']
-                self._obis_points[0x00000006]['value'] = -self._obis_points[0x00330400]['value'] if self._obis_points[0x002a0400]['value'] > 0 else self._obis_points[0x00330400]['value']
-                self._obis_points[0x00000007]['value'] = -self._obis_points[0x00470400]['value'] if self._obis_points[0x003E0400]['value'] > 0 else self._obis_points[0x00470400]['value']
+        return True
 
-                if self._hardware[SMASusyID]['active'] == False:
-                    swr = self._obis_points[0x90000000]['value']
-                    sw = str((swr >> 24) & 0xFF)
-                    sw += '.' + str((swr >> 16) & 0xFF)
-                    sw += '.' + str((swr >> 8) & 0xFF)
-                    sw += '.' + chr(swr & 0xFF)
-                    self._hardware[SMASusyID]['sw'] = sw
-                    self._dbusservice['/FirmwareVersion'] = self._hardware[SMASusyID]['sw']
-                    self._hardware[SMASusyID]['active'] = True
+class MeterDispatcher(object):
+    def __init__(self):
+        # serial -> DbusSMAEMService, None for ignored meters
+        self._services = {}
+        self._deviceinstances = set(meter['deviceinstance'] for meter in METERS.values() if 'deviceinstance' in meter)
+        self._single = None
 
-                for obis_value in self._obis_points.values():
-                    if obis_value['path'] != '':
-                        self._dbusservice[obis_value['path']] = obis_value['value']
+        if not AUTO_DISCOVERY:
+            # classic mode, one grid meter which is visible before the first datagram arrives
+            self._single = DbusSMAEMService(
+                servicename='com.victronenergy.grid.smaem', deviceinstance=0)
 
-                # increment UpdateIndex - to show that new data is available
-                index = self._dbusservice['/UpdateIndex'] + 1
-                if index > 255:
-                    index = 0
-                self._dbusservice['/UpdateIndex'] = index
+    def dispatch(self, serial, data, timestamp=None):
+        try:
+            service = self._services[serial]
+        except KeyError:
+            service = self._add(serial)
+
+        if service is not None:
+            receiver_stats.accepted += 1
+            service._update(data, timestamp)
+        else:
+            receiver_stats.rejected['Serial'] += 1
+
+    def _add(self, serial):
+        service = None
+
+        if self._single is not None:
+            # check serialnumber, if not equal ignore the meter
+            if EM_SERIAL == 0 or serial == EM_SERIAL:
+                service = self._single
+
+        else:
+            meter = METERS.get(serial, {})
+            role = meter.get('role', DEFAULT_ROLE)
+            if role is not None:
+                deviceinstance = meter.get('deviceinstance')
+                if deviceinstance is None:
+                    deviceinstance = self._auto_deviceinstance(serial)
+                self._deviceinstances.add(deviceinstance)
+
+                logger.info('Discovered SMA meter %d, role %s, device instance %d' % (serial, role, deviceinstance))
+                servicename = 'com.victronenergy.%s.smaem_%d' % (role, serial)
+                try:
+                    service = DbusSMAEMService(
+                        servicename=servicename, deviceinstance=deviceinstance, role=role,
+                        position=meter.get('position', 0), sign=meter.get('sign', ROLE_SIGNS.get(role, 1)))
+                except Exception as e:
+                    # e.g. the name exists already, the meter is ignored and the others keep running
+                    receiver_stats.service_errors += 1
+                    logger.error('Could not create %s, ignoring SMA meter %d: %s' % (servicename, serial, e), exc_info=True)
+                    self._services[serial] = None
+                    return None
+
+        if service is None:
+            logger.info('Ignoring SMA meter %d' % serial)
+        self._services[serial] = service
+        return service
+
+    def _auto_deviceinstance(self, serial):
+        # stable for a serial unless two meters share the slot, then the next free one is taken in
+        # the order the meters are discovered
+        first, last = AUTO_DEVICEINSTANCES
+        count = last - first + 1
+        slot = serial % count
+        for n in range(count):
+            deviceinstance = first + (slot + n) % count
+            if deviceinstance not in self._deviceinstances:
+                break
+        if n:
+            logger.warning('Device instance of SMA meter %d depends on the order of discovery, '
+                           'set its deviceinstance in METERS' % serial)
+        return deviceinstance
+
+    def services(self):
+        services = set(self._services.values())
+        services.add(self._single)
+        services.discard(None)
+        return services
+
+    def log_stats(self):
+        for service in self.services():
+            service.log_stats()
+        return True
 
-        except:
-            logger.info("WARNING: Could not read from SMA Energy Meter")
-            self._dbusservice['/Ac/Power'] = 0
+class Watchdog(object):
+    # marks silent meters as disconnected and joins the multicast group again with exponential backoff
+    def __init__(self, receiver, dispatcher):
+        self._receiver = receiver
+        self._dispatcher = dispatcher
+        self._delay = RECONNECT_DELAY
+        self._next_reconnect = None
+        self._attempts = 0
+        GLib.timeout_add_seconds(max(1, SILENCE_TIMEOUT // 5), self._check)
+
+    def _check(self):
+        now = time.monotonic()
+        for service in self._dispatcher.services():
+            service.check_silence(now)
+
+        if now - self._receiver.last_datagram < SILENCE_TIMEOUT:
+            self._delay = RECONNECT_DELAY
+            self._next_reconnect = None
+            self._attempts = 0
+            return True
+
+        if self._receiver.silent_since is None:
+            logger.warning('No datagram from any SMA meter for %d s' % (now - self._receiver.last_datagram))
+            self._receiver.silent_since = now
+            # the first attempt after RECONNECT_DELAY, a short gap is not worth a reconnect
+            self._next_reconnect = now + self._delay
+            self._delay = min(self._delay * 2, RECONNECT_MAX_DELAY)
+
+        if now >= self._next_reconnect:
+            # first join the group again, then create a new socket
+            self._attempts += 1
+            receiver_stats.reconnects += 1
+            self._receiver.reconnect(recreate=self._attempts > 1)
+            self._next_reconnect = now + self._delay
+            self._delay = min(self._delay * 2, RECONNECT_MAX_DELAY)
 
         return True
 
-    def _handlechangedvalue(self, path, value):
-        logger.debug("someone else updated %s to %s" % (path, value))
-        return True  # accept the change
-
 def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Publish SMA energy meter values on dbus')
+    multicast.add_arguments(parser)
+    args = parser.parse_args()
+    socket_config = multicast.config_from_args(args)
 
     from dbus.mainloop.glib import DBusGMainLoop
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
     DBusGMainLoop(set_as_default=True)
 
-    pvac_output = DbusSMAEMService(
-        servicename='com.victronenergy.grid.smaem', deviceinstance=0)
+    if SINKS:
+        from sinks import create_sinks
+        sinks.extend(create_sinks(SINKS))
+    for sink in list(sinks):
+        try:
+            sink.start()
+        except Exception as e:
+            # a consumer must never stop the meter
+            logger.error('Could not start %s sink: %s' % (sink.name, e))
+            sinks.remove(sink)
+            continue
+        logger.info('Started %s sink' % sink.name)
+    startup.mark('Setup')
+
+    dispatcher = MeterDispatcher()
+    startup.mark('Services')
+    receiver = SpeedwireReceiver(dispatcher.dispatch, socket_config)
+    startup.mark('Socket')
+    # the log file is opened after the first reading, or after LOG_FILE_DELAY without any
+    GLib.timeout_add_seconds(LOG_FILE_DELAY, add_log_file)
+    watchdog = Watchdog(receiver, dispatcher)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, dispatcher.log_stats)
 
     mainloop = GLib.MainLoop()
     mainloop.run()
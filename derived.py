@@ -0,0 +1,142 @@
+# Derived values
+#
+# Values which are calculated from the decoded OBIS channels. Every metric is declared by its
+# output name and dbus path, its inputs and a function. Names with {phase} stand for the vector
+# of the three phases L1, L2 and L3, all other names for a vector with one element, so every
+# function calculates all phases at once. A metric is only calculated again if one of its inputs
+# changed since the last datagram.
+
+import cmath
+import math
+import re
+
+PHASES = ('L1', 'L2', 'L3')
+# phase angles of L1, L2 and L3 for the neutral current estimate
+_ROTATION = (cmath.rect(1, 0), cmath.rect(1, -2 * math.pi / 3), cmath.rect(1, 2 * math.pi / 3))
+
+
+def _difference(a, b):
+    return [round(x - y, 2) for x, y in zip(a, b)]
+
+
+def _sum(a, b):
+    return [round(x + y, 2) for x, y in zip(a, b)]
+
+
+def _identity(a):
+    return list(a)
+
+
+def _signed_current(current, surplus):
+    # the meter only sends the amount of the current, negative if the phase feeds in
+    return [-i if s > 0 else i for i, s in zip(current, surplus)]
+
+
+def _power_factor(power, apparent):
+    # negative if the phase feeds in
+    return [round(p / s, 3) if s else 0 for p, s in zip(power, apparent)]
+
+
+def _imbalance(current):
+    # maximum deviation from the mean current in percent of the mean current
+    current = [abs(i) for i in current]
+    mean = sum(current) / 3
+    if not mean:
+        return [0]
+    return [round(max(abs(i - mean) for i in current) / mean * 100, 1)]
+
+
+def _neutral_current(current, power_factor):
+    # sum of the phase current phasors, assumes symmetrical voltages and inductive loads
+    neutral = 0
+    for i, pf, rotation in zip(current, power_factor, _ROTATION):
+        neutral += i * rotation * cmath.rect(1, -math.acos(min(abs(pf), 1)))
+    return [round(abs(neutral), 2)]
+
+
+# (output name, dbus path or '', unit, input names, function), inputs can be channel names of the
+# channel map or outputs of metrics declared above
+DERIVED_METRICS = [
+    ('power',                   '/Ac/Power',                  'W',  ('pregard', 'surplus'),                                   _difference),
+    ('{phase}_power',           '/Ac/{phase}/Power',          'W',  ('{phase}_pregard', '{phase}_surplus'),                   _difference),
+    ('{phase}_signed_current',  '/Ac/{phase}/Current',        'A',  ('{phase}_current', '{phase}_surplus'),                   _signed_current),
+    ('import_power',            '/Ac/ImportPower',            'W',  ('pregard',),                                             _identity),
+    ('export_power',            '/Ac/ExportPower',            'W',  ('surplus',),                                             _identity),
+    ('{phase}_import_power',    '/Ac/{phase}/ImportPower',    'W',  ('{phase}_pregard',),                                     _identity),
+    ('{phase}_export_power',    '/Ac/{phase}/ExportPower',    'W',  ('{phase}_surplus',),                                     _identity),
+    ('apparent_power',          '/Ac/ApparentPower',          'VA', ('apparent_pregard', 'apparent_surplus'),                 _sum),
+    ('{phase}_apparent_power',  '/Ac/{phase}/ApparentPower',  'VA', ('{phase}_apparent_pregard', '{phase}_apparent_surplus'), _sum),
+    ('signed_power_factor',     '/Ac/PowerFactor',            '',   ('power', 'apparent_power'),                              _power_factor),
+    ('{phase}_signed_power_factor', '/Ac/{phase}/PowerFactor', '',  ('{phase}_power', '{phase}_apparent_power'),              _power_factor),
+    ('current_imbalance',       '/Ac/CurrentImbalance',       '%',  ('{phase}_signed_current',),                              _imbalance),
+    ('neutral_current',         '/Ac/NeutralCurrent',         'A',  ('{phase}_signed_current', '{phase}_signed_power_factor'), _neutral_current),
+]
+
+
+def swap_direction(text, first='pregard', second='surplus'):
+    # exchanges the two directions in a channel name or a path
+    return re.sub('%s|%s' % (first, second), lambda match: second if match.group() == first else first, text)
+
+
+def reversed_metrics(metrics=DERIVED_METRICS):
+    # for meters of producers, e.g. a PV inverter: import and export change places, so the power
+    # is positive while the producer feeds in
+    return [(name, path, unit, tuple(swap_direction(input_name) for input_name in inputs), function)
+            for name, path, unit, inputs, function in metrics]
+
+
+class _Metric(object):
+    __slots__ = ('inputs', 'outputs', 'function', 'last')
+
+    def __init__(self, inputs, outputs, function):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.function = function
+        self.last = None
+
+
+class DerivedStage(object):
+
+    def __init__(self, obis_points, metrics=DERIVED_METRICS):
+        channels = {point['name']: point for point in obis_points.values()}
+        # name -> {'name', 'unit', 'path', 'value'}, in the order of the metrics
+        self.points = {}
+        self.skipped = []
+        self._metrics = []
+
+        for name, path, unit, inputs, function in metrics:
+            groups = []
+            for input_name in inputs:
+                group = [self.points.get(n) or channels.get(n) for n in self._expand(input_name)]
+                if None in group:
+                    break
+                groups.append(group)
+            else:
+                names = self._expand(name)
+                paths = self._expand(path) if path else [''] * len(names)
+                outputs = []
+                for output_name, output_path in zip(names, paths):
+                    point = {'name': output_name, 'unit': unit, 'path': output_path, 'value': 0}
+                    self.points[output_name] = point
+                    outputs.append(point)
+                self._metrics.append(_Metric(groups, outputs, function))
+                continue
+
+            # an input channel is disabled in the channel map
+            self.skipped.append(name)
+
+    @staticmethod
+    def _expand(name):
+        if '{phase}' in name:
+            return [name.format(phase=phase) for phase in PHASES]
+        return [name]
+
+    def update(self):
+        for metric in self._metrics:
+            values = tuple(tuple(point['value'] for point in group) for group in metric.inputs)
+            if values == metric.last:
+                continue
+            metric.last = values
+
+            for point, value in zip(metric.outputs, metric.function(*values)):
+                point['value'] = value
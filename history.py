@@ -0,0 +1,381 @@
+# Local meter history
+#
+# Optional time series store below /data, fed from the dbus service. Every tier (raw values,
+# 1 min and 15 min rollups) is a directory of segment files with fixed-width binary records,
+# sorted by time:
+#
+#   header (HEADER_SIZE bytes): magic, record size, capacity, count, JSON list of channel names
+#   raw records:    time, value per channel                  (float64 each)
+#   rollup records: time, mean, min and max per channel      (float64 each)
+#
+# add() and flush() only queue the work, a worker thread computes the rollups, starts new
+# segments, deletes old ones and writes, so a slow fsync of the SD card never delays the GLib main
+# loop and /Ac/Power. Its queue is bounded and drops the oldest records if the card stalls. An
+# error of the worker stops it and is raised by the next add() or flush().
+#
+# Records are kept in memory until flush() appends them to all open segments and syncs them. It
+# is called by a timer, so the SD card is not written for every datagram, records newer than the
+# last flush are lost when the service stops without close(). Segments older than the retention
+# of their tier are deleted when a new segment is started.
+#
+# The segments are written with write() and fsync(), not through a writable memory mapping: a
+# mapping turns a full /data into a SIGBUS which kills the service, write() raises an OSError
+# which only disables the history. Queries still read the segments through read-only mappings.
+#
+# Query from the command line:
+#
+#   python3 history.py DIR --list
+#   python3 history.py DIR --channel power [--tier 1min] [--start '2026-10-16 10:00'] [--end ...]
+
+import argparse
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime
+
+MAGIC = b'SWHIST01'
+HEADER_SIZE = 4096
+_HEADER = struct.Struct('<8sIII')
+
+# (name, rollup period in seconds or 0 for raw values, segment length in seconds, retention in seconds)
+DEFAULT_TIERS = [
+    ('raw',   0,   3600,       2 * 86400),
+    ('1min',  60,  86400,      90 * 86400),
+    ('15min', 900, 30 * 86400, 5 * 365 * 86400),
+]
+# highest expected datagram rate in Hz, sizes the raw segments
+MAX_RATE = 10
+# records waiting for the worker thread, the oldest is dropped when a new one does not fit
+QUEUE_SIZE = 4096
+# seconds close() waits for the worker, a worker stuck in a write ends with the process
+CLOSE_TIMEOUT = 5
+
+
+class _Segment(object):
+    # records are collected in memory and appended with write() and fsync() by flush(), so a
+    # full /data raises an OSError there instead of a SIGBUS in a memory mapping
+
+    def __init__(self, filename, channels, record, capacity):
+        self.record = record
+        self.capacity = capacity
+        self.count = 0
+        self._written = 0
+        self._pending = bytearray()
+
+        names = json.dumps(channels).encode()
+        if _HEADER.size + len(names) > HEADER_SIZE:
+            raise ValueError('too many history channels')
+        header = bytearray(HEADER_SIZE)
+        _HEADER.pack_into(header, 0, MAGIC, record.size, capacity, 0)
+        header[_HEADER.size:_HEADER.size + len(names)] = names
+
+        # the header is on disk before the first flush, readers never see an empty segment
+        self._file = open(filename, 'w+b')
+        try:
+            self._file.write(header)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            self._file.close()
+            raise
+
+    def append(self, values):
+        self._pending += self.record.pack(*values)
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def flush(self):
+        if self.count == self._written:
+            return
+        self._file.seek(HEADER_SIZE + self._written * self.record.size)
+        self._file.write(self._pending)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        # the count is written after the records, a crash never exposes a half written record
+        self._file.seek(16)
+        self._file.write(struct.pack('<I', self.count))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = bytearray()
+        self._written = self.count
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+
+class _TierWriter(object):
+
+    def __init__(self, directory, channels, period, length, retention, values_per_channel):
+        self._directory = directory
+        self._channels = channels
+        self._length = length
+        self._retention = retention
+        self._record = struct.Struct('<d' + 'd' * len(channels) * values_per_channel)
+        if period:
+            self._capacity = int(length / period) + 1
+        else:
+            self._capacity = int(length * MAX_RATE) + 1
+        self._segment = None
+        self._segment_end = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, timestamp, values):
+        if self._segment is None or self._segment.full or timestamp >= self._segment_end:
+            self._roll(timestamp)
+        self._segment.append((timestamp,) + tuple(values))
+
+    def _roll(self, timestamp):
+        if self._segment is not None:
+            segment, self._segment = self._segment, None
+            segment.close()
+
+        self._evict(timestamp)
+        filename = os.path.join(self._directory, '%d.seg' % (timestamp * 1000))
+        self._segment = _Segment(filename, self._channels, self._record, self._capacity)
+        self._segment_end = timestamp + self._length
+
+    def _evict(self, now):
+        for start, filename in _segments(self._directory):
+            if start + self._length < now - self._retention:
+                os.remove(filename)
+
+    def flush(self):
+        if self._segment is not None:
+            self._segment.flush()
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+
+class _Rollup(object):
+    # mean, min and max of every channel over one period
+
+    def __init__(self, writer, period, size):
+        self._writer = writer
+        self._period = period
+        self._size = size
+        self._start = None
+
+    def add(self, timestamp, values):
+        start = timestamp - timestamp % self._period
+        if start != self._start:
+            if self._start is not None and self._count:
+                self._writer.append(self._start, [s / self._count for s in self._sum] + self._min + self._max)
+            self._start = start
+            self._count = 0
+            self._sum = [0.0] * self._size
+            self._min = list(values)
+            self._max = list(values)
+
+        self._count += 1
+        for i, value in enumerate(values):
+            self._sum[i] += value
+            if value < self._min[i]:
+                self._min[i] = value
+            elif value > self._max[i]:
+                self._max[i] = value
+
+
+class HistoryWriter(object):
+    # add(), flush() and close() are called from the GLib main loop, everything else runs in the
+    # worker thread
+
+    def __init__(self, directory, channels, tiers=DEFAULT_TIERS, queue_size=QUEUE_SIZE):
+        self.channels = list(channels)
+        self.dropped = 0
+        self.error = None
+        self._raw = []
+        self._rollups = []
+        self._writers = []
+        self._queue = collections.deque(maxlen=queue_size)
+        self._flush_requested = False
+        self._wakeup = threading.Event()
+        self._running = True
+
+        for name, period, length, retention in tiers:
+            tier = os.path.join(directory, name)
+            if period:
+                writer = _TierWriter(tier, self.channels, period, length, retention, 3)
+                self._rollups.append(_Rollup(writer, period, len(self.channels)))
+            else:
+                writer = _TierWriter(tier, self.channels, period, length, retention, 1)
+                self._raw.append(writer)
+            self._writers.append(writer)
+
+        self._thread = threading.Thread(target=self._run, name='history', daemon=True)
+        self._thread.start()
+
+    def add(self, timestamp, values):
+        # values in the order of channels, deque.append is atomic and drops the oldest record
+        if self.error is not None:
+            raise self.error
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append((timestamp, values))
+        self._wakeup.set()
+
+    def flush(self):
+        # raises the error of the worker, e.g. an OSError if /data is full
+        if self.error is not None:
+            raise self.error
+        self._flush_requested = True
+        self._wakeup.set()
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(CLOSE_TIMEOUT)
+        if self._thread.is_alive():
+            return
+        try:
+            if self.error is None:
+                self._drain()
+        finally:
+            for writer in self._writers:
+                writer.close()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self._drain()
+                if self._flush_requested:
+                    self._flush_requested = False
+                    for writer in self._writers:
+                        writer.flush()
+            except Exception as e:
+                self.error = e
+                return
+
+    def _drain(self):
+        while self._queue:
+            timestamp, values = self._queue.popleft()
+            for writer in self._raw:
+                writer.append(timestamp, values)
+            for rollup in self._rollups:
+                rollup.add(timestamp, values)
+
+
+def _segments(directory):
+    # [(start time, filename)] sorted by start time
+    segments = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.seg'):
+                segments.append((int(name[:-4]) / 1000, os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+def _read_segment(filename):
+    # returns (channels, record struct, count, mapping) without reading the records, None for a
+    # segment without complete header (a crash right after it was created)
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+            return None
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, size, capacity, count = _HEADER.unpack_from(mapping)
+    if magic != MAGIC:
+        mapping.close()
+        raise ValueError('%s is not a history segment' % filename)
+    names = bytes(mapping[_HEADER.size:HEADER_SIZE]).rstrip(b'\0')
+    channels = json.loads(names.decode())
+    return channels, struct.Struct('<%dd' % (size // 8)), count, mapping
+
+
+def _first_index(mapping, record, count, start):
+    # binary search for the first record at or after start
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if struct.unpack_from('<d', mapping, HEADER_SIZE + middle * record.size)[0] < start:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def query(directory, channel, start=0, end=float('inf'), tier='raw'):
+    # yields (time, value) for raw values, (time, mean, min, max) for rollups
+    segments = _segments(os.path.join(directory, tier))
+    for i, (segment_start, filename) in enumerate(segments):
+        if segment_start > end:
+            break
+        if i + 1 < len(segments) and segments[i + 1][0] <= start:
+            continue
+
+        segment = _read_segment(filename)
+        if segment is None:
+            continue
+        channels, record, count, mapping = segment
+        try:
+            if channel not in channels:
+                continue
+            index = channels.index(channel)
+            per_channel = (record.size // 8 - 1) // len(channels)
+            for n in range(_first_index(mapping, record, count, start), count):
+                values = record.unpack_from(mapping, HEADER_SIZE + n * record.size)
+                if values[0] > end:
+                    break
+                yield (values[0],) + tuple(values[1 + index + k * len(channels)] for k in range(per_channel))
+        finally:
+            mapping.close()
+
+
+def channels(directory, tier='raw'):
+    # channel names and time range of the stored values
+    segments = _segments(os.path.join(directory, tier))
+    for segment_start, filename in reversed(segments):
+        segment = _read_segment(filename)
+        if segment is None:
+            continue
+        names, record, count, mapping = segment
+        last = struct.unpack_from('<d', mapping, HEADER_SIZE + (count - 1) * record.size)[0] if count else segment_start
+        mapping.close()
+        return names, segments[0][0], last
+    return [], None, None
+
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the meter history')
+    parser.add_argument('directory', help='history directory of one meter')
+    parser.add_argument('--tier', default='raw', help='raw, 1min or 15min')
+    parser.add_argument('--channel', help='channel name')
+    parser.add_argument('--start', default='0', help='start time, seconds since epoch or ISO format')
+    parser.add_argument('--end', default='inf', help='end time, seconds since epoch or ISO format')
+    parser.add_argument('--list', action='store_true', help='list channels and time range')
+    args = parser.parse_args()
+
+    if args.list or not args.channel:
+        names, first, last = channels(args.directory, args.tier)
+        if first is None:
+            raise SystemExit('no %s history in %s' % (args.tier, args.directory))
+        print('%s .. %s' % (datetime.fromtimestamp(first), datetime.fromtimestamp(last)))
+        print(' '.join(names))
+        return
+
+    for values in query(args.directory, args.channel, _parse_time(args.start), _parse_time(args.end), args.tier):
+        print(datetime.fromtimestamp(values[0]).isoformat(sep=' ', timespec='milliseconds') + ',' + ','.join('%g' % v for v in values[1:]))
+
+
+if __name__ == "__main__":
+    main()
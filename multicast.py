@@ -0,0 +1,241 @@
+# Multicast socket of the receiver
+#
+# Settings come from DEFAULT_CONFIG, the optional socket.json next to this module and the command
+# line, in this order, so nothing has to be edited in the scripts. socket.json contains an object
+# with any of the keys of DEFAULT_CONFIG, e.g. {"interface": "eth0", "rcvbuf": 262144}.
+
+import errno
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'group': '239.12.255.254',
+    'port': 9522,
+    # name ('eth0') or address of the interface(s) to join the group on, a list joins on every
+    # interface, None lets the kernel choose one by the routing table
+    'interface': None,
+    # receive buffer in bytes, None keeps the kernel default (net.core.rmem_default)
+    'rcvbuf': None,
+    # size of every receive buffer, SHM2.0 datagrams are longer than the ones of the SMA-EM
+    'recv_size': 10240,
+    # number of receive buffers, the most datagrams read per wakeup
+    'batch': 64,
+    # receive time stamps of the kernel instead of the time the datagram was read
+    'timestamps': True,
+    # source addresses or networks, datagrams of others are dropped before they are decoded.
+    # An empty allow list allows everybody who is not denied.
+    'allow': [],
+    'deny': [],
+}
+DEFAULT_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket.json')
+
+# socket options which are not exported by every python version, values of Linux
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+# struct timeval by its size, 32 bit builds with a 64 bit time_t get the 16 byte one
+_TIMEVALS = {timeval.size: timeval for timeval in (struct.Struct('@ll'), struct.Struct('@qq'))}
+
+
+def load_config(filename=DEFAULT_CONFIG_FILE, overrides=None):
+    config = dict(DEFAULT_CONFIG)
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            config.update(json.load(f))
+    if overrides:
+        config.update((key, value) for key, value in overrides.items() if value is not None)
+
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('unknown socket settings: %s' % ', '.join(sorted(unknown)))
+    return config
+
+
+def add_arguments(parser):
+    parser.add_argument('--socket-config', metavar='FILE', default=DEFAULT_CONFIG_FILE, help='socket settings (JSON)')
+    parser.add_argument('--group', help='multicast group')
+    parser.add_argument('--port', type=int, help='UDP port')
+    parser.add_argument('--interface', action='append', help='name or address of the interface to join the group on, can be repeated')
+    parser.add_argument('--rcvbuf', type=int, help='socket receive buffer in bytes')
+    parser.add_argument('--allow', action='append', help='only accept datagrams of this source address or network, can be repeated')
+    parser.add_argument('--deny', action='append', help='drop datagrams of this source address or network, can be repeated')
+
+
+def config_from_args(args):
+    return load_config(args.socket_config, {
+        'group': args.group,
+        'port': args.port,
+        'interface': args.interface,
+        'rcvbuf': args.rcvbuf,
+        'allow': args.allow,
+        'deny': args.deny,
+    })
+
+
+def _interfaces(config):
+    interfaces = config['interface']
+    if interfaces is None:
+        return [None]
+    if isinstance(interfaces, str):
+        return [interfaces]
+    return interfaces
+
+
+def memberships(config):
+    # one struct ip_mreqn per interface, by address or by interface index
+    group = socket.inet_aton(config['group'])
+    result = []
+    for interface in _interfaces(config):
+        if interface is None:
+            result.append(struct.pack('4s4si', group, socket.inet_aton('0.0.0.0'), 0))
+            continue
+        try:
+            address = socket.inet_aton(interface)
+            index = 0
+        except OSError:
+            address = socket.inet_aton('0.0.0.0')
+            index = socket.if_nametoindex(interface)
+        result.append(struct.pack('4s4si', group, address, index))
+    return result
+
+
+def join(sock, config, leave_first=False):
+    for membership in memberships(config):
+        if leave_first:
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, membership)
+            except OSError:
+                pass
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            # two names of the same interface
+            if e.errno != errno.EADDRINUSE:
+                raise
+
+
+def open_socket(config):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if config['rcvbuf']:
+            # SO_RCVBUFFORCE ignores net.core.rmem_max but needs CAP_NET_ADMIN
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, config['rcvbuf'])
+            except OSError:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config['rcvbuf'])
+            logger.info('Socket receive buffer is %d bytes' % sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+        sock.bind(("", config['port']))
+        # Linux delivers the datagrams of every group joined by any socket on the host to all
+        # sockets bound to the port, only receive the groups joined on this socket
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+        except OSError:
+            pass
+        join(sock, config)
+
+        # let the kernel report the number of datagrams dropped because the receive queue was full
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            logger.info('Socket receive queue drops are not available')
+
+        if config['timestamps']:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+            except OSError:
+                logger.info('Kernel receive time stamps are not available')
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class SourceFilter(object):
+    # remembers the decision per source address, so the networks are only checked once
+
+    def __init__(self, allow=(), deny=()):
+        # only imported if there is a filter, it is not needed for the start of the service
+        import ipaddress
+        self._ip_address = ipaddress.ip_address
+        self._allow = [ipaddress.ip_network(network, strict=False) for network in allow]
+        self._deny = [ipaddress.ip_network(network, strict=False) for network in deny]
+        self._decisions = {}
+
+    def __call__(self, address):
+        try:
+            return self._decisions[address]
+        except KeyError:
+            ip = self._ip_address(address)
+            accepted = (not self._allow or any(ip in network for network in self._allow)) and \
+                not any(ip in network for network in self._deny)
+            if len(self._decisions) < 1024:
+                self._decisions[address] = accepted
+            return accepted
+
+
+class BatchReader(object):
+    # reads up to 'batch' datagrams per call into a pool of preallocated buffers, python has no
+    # recvmmsg. The returned views are valid until the next call.
+
+    def __init__(self, sock, config, stats):
+        self._sock = sock
+        self._stats = stats
+        self._pool = [bytearray(config['recv_size']) for _ in range(config['batch'])]
+        self._views = [memoryview(buffer) for buffer in self._pool]
+        self._ancbufsize = socket.CMSG_SPACE(4) + socket.CMSG_SPACE(max(_TIMEVALS))
+        self._accept = SourceFilter(config['allow'], config['deny']) if config['allow'] or config['deny'] else None
+        # kernel drop counter of the previous sockets
+        self._dropped = stats.dropped
+
+    def reset(self, sock):
+        # a new socket starts its drop counter at zero
+        self._sock = sock
+        self._dropped = self._stats.dropped
+
+    def read(self):
+        # [(datagram view, source address, receive time in seconds since epoch)], the first read
+        # blocks on a blocking socket
+        datagrams = []
+        flags = 0
+        for buffer, view in zip(self._pool, self._views):
+            try:
+                size, ancdata, msg_flags, address = self._sock.recvmsg_into([buffer], self._ancbufsize, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.warning('Could not receive from socket: %s' % e)
+                break
+            flags = socket.MSG_DONTWAIT
+
+            self._stats.received += 1
+            timestamp = None
+            for level, kind, value in ancdata:
+                if level == socket.SOL_SOCKET:
+                    if kind == SO_RXQ_OVFL:
+                        self._stats.dropped = self._dropped + struct.unpack('=I', value)[0]
+                    elif kind == SO_TIMESTAMP:
+                        timeval = _TIMEVALS.get(len(value))
+                        if timeval is not None:
+                            seconds, microseconds = timeval.unpack(value)
+                            timestamp = seconds + microseconds / 1e6
+            if timestamp is None:
+                timestamp = time.time()
+            if msg_flags & socket.MSG_TRUNC:
+                self._stats.truncated += 1
+
+            if self._accept is not None and not self._accept(address[0]):
+                self._stats.rejected['Source'] += 1
+                continue
+
+            datagrams.append((view[:size], address[0], timestamp))
+        return datagrams
@@ -0,0 +1,95 @@
+# D-Bus publisher
+#
+# Sits between the decoded values and the VeDbusService. Values are compared against the last
+# published value of the path and only sent if they changed by more than the deadband of the
+# path. All changes of one datagram are sent inside one VeDbusService context, which emits a
+# single ItemsChanged signal instead of one PropertiesChanged signal per path.
+
+from fnmatch import fnmatchcase
+
+# (path pattern, deadband), first match wins. Paths without match are published on every change.
+DEFAULT_DEADBANDS = [
+    ('/Ac/Aggregate/*/Energy/*', 0.001),  # kWh
+    ('/Ac/Aggregate/*/Power/*',  1),      # W
+    ('/Ac/Energy/*',             0.01),   # kWh
+    ('/Ac/*/Energy/*',           0.01),   # kWh
+    ('/Ac/*Power',               1),      # W, VA
+    ('/Ac/*Current',             0.01),   # A
+    ('/Ac/CurrentImbalance',     0.5),    # %
+    ('/Ac/Frequency',            0.01),   # Hz
+    ('/Ac/*PowerFactor',         0.01),
+]
+
+
+class DbusPublisher(object):
+
+    def __init__(self, dbusservice, deadbands=DEFAULT_DEADBANDS):
+        self._dbusservice = dbusservice
+        self._deadbands = deadbands
+        self._path_deadbands = {}
+        self._published = {}
+
+        # counters
+        self.published = 0
+        self.suppressed = 0
+
+    def publish(self, values, update_index=False):
+        # values is an iterable of (path, value), returns the number of published paths. With
+        # update_index /UpdateIndex is incremented in the same signal if anything is published.
+        published = self._published
+        changes = []
+
+        for path, value in values:
+            if path in published:
+                last = published[path]
+                if value == last:
+                    self.suppressed += 1
+                    continue
+
+                deadband = self._deadband(path)
+                if deadband and isinstance(value, (int, float)) and isinstance(last, (int, float)) \
+                        and abs(value - last) < deadband:
+                    self.suppressed += 1
+                    continue
+
+            changes.append((path, value))
+
+        if changes:
+            if update_index:
+                index = self._dbusservice['/UpdateIndex'] + 1
+                changes.append(('/UpdateIndex', index if index <= 255 else 0))
+            with self._dbusservice as s:
+                for path, value in changes:
+                    s[path] = value
+                    published[path] = value
+            self.published += len(changes)
+
+        return len(changes)
+
+    def set(self, path, value):
+        # publish without deadband, e.g. to reset a value
+        self._dbusservice[path] = value
+        self._published[path] = value
+        self.published += 1
+
+    def known(self, path):
+        # True if the path was published and not forgotten since
+        return path in self._published
+
+    def forget(self, path=None):
+        # forget the last published value, e.g. after someone else wrote the path
+        if path is None:
+            self._published.clear()
+        else:
+            self._published.pop(path, None)
+
+    def _deadband(self, path):
+        deadband = self._path_deadbands.get(path)
+        if deadband is None:
+            deadband = 0
+            for pattern, value in self._deadbands:
+                if fnmatchcase(path, pattern):
+                    deadband = value
+                    break
+            self._path_deadbands[path] = deadband
+        return deadband
@@ -0,0 +1,96 @@
+# Publish scheduler
+#
+# Sits between the service and the DbusPublisher and gives every path a publish interval. Paths
+# with interval 0 are published together with the datagram, e.g. the power for the ESS control
+# loop. All others only keep their latest value, which a GLib timer per interval publishes, so a
+# meter sending every 200 ms does not update voltages and counters five times a second.
+# /UpdateIndex is only incremented when something is actually published. A path which was never
+# published (or forgotten by the publisher, e.g. after a reconnect) is published immediately, so
+# the first reading does not show the registered 0 until its interval has passed.
+
+from fnmatch import fnmatchcase
+
+from gi.repository import GLib
+
+# (path pattern, interval in seconds), first match wins. Paths without match are published with
+# every datagram.
+DEFAULT_INTERVALS = [
+    ('/Ac/Power',       0),   # W, immediately
+    ('/Ac/L?/Power',    0),   # W, immediately
+    ('/Ac/Aggregate/*', 1),
+    ('/Ac/Energy/*',    10),  # kWh
+    ('/Ac/*/Energy/*',  10),  # kWh
+    ('/Ac/*',           1),   # voltages, currents, other powers, frequency, aggregates
+]
+
+
+class PublishScheduler(object):
+
+    def __init__(self, publisher, intervals=DEFAULT_INTERVALS):
+        self._publisher = publisher
+        self._intervals = intervals
+        self._path_intervals = {}
+        # interval -> {path: latest value}
+        self._pending = {}
+
+        # values replaced by a newer one before they were published
+        self.decimated = 0
+
+    def _interval(self, path):
+        interval = self._path_intervals.get(path)
+        if interval is None:
+            interval = 0
+            for pattern, value in self._intervals:
+                if fnmatchcase(path, pattern):
+                    interval = value
+                    break
+            self._path_intervals[path] = interval
+        return interval
+
+    def update(self, values):
+        # values of one datagram as (path, value)
+        immediate = []
+        known = self._publisher.known
+        for path, value in values:
+            interval = self._interval(path)
+            if not interval:
+                immediate.append((path, value))
+                continue
+            if not known(path):
+                immediate.append((path, value))
+                # an older value must not overwrite this one with the next timer
+                pending = self._pending.get(interval)
+                if pending:
+                    pending.pop(path, None)
+                continue
+
+            pending = self._pending.get(interval)
+            if pending is None:
+                pending = self._pending[interval] = {}
+                self._start(interval)
+            if path in pending:
+                self.decimated += 1
+            pending[path] = value
+
+        if immediate:
+            self._publisher.publish(immediate, update_index=True)
+
+    def _start(self, interval):
+        # whole seconds use the coalesced timer of GLib, which wakes the GX less often
+        if interval >= 1 and interval == int(interval):
+            GLib.timeout_add_seconds(int(interval), self._flush, interval)
+        else:
+            GLib.timeout_add(int(interval * 1000), self._flush, interval)
+
+    def _flush(self, interval):
+        pending = self._pending[interval]
+        if pending:
+            values = list(pending.items())
+            pending.clear()
+            self._publisher.publish(values, update_index=True)
+        return True
+
+    def clear(self):
+        # drop the values which are not published yet, e.g. when the meter is disconnected
+        for pending in self._pending.values():
+            pending.clear()
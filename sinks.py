@@ -0,0 +1,273 @@
+# Output sinks
+#
+# Fan out the decoded values of every datagram to local consumers besides dbus, so they do not
+# have to listen to the multicast group and decode Speedwire themselves. put() is called from the
+# GLib main loop and never blocks: every sink has its own bounded queue which drops the oldest
+# snapshot when the consumer is too slow, and a worker thread which does the network I/O.
+#
+# A snapshot is a dict {'serial': serial, 'time': seconds since epoch, 'values': {name: value}}
+# with the channel names of obis.json and the derived values.
+
+import collections
+import json
+import logging
+import socket
+import socketserver
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# snapshots waiting per sink, the oldest is dropped when a new one does not fit
+QUEUE_SIZE = 16
+
+# Modbus-TCP register map, name -> first register of a float32 (big endian, two registers).
+# Holding (function 3) and input registers (function 4) return the same values.
+DEFAULT_REGISTERS = {
+    'power':          0,
+    'L1_power':       2,
+    'L2_power':       4,
+    'L3_power':       6,
+    'import_power':   8,
+    'export_power':   10,
+    'pregardcounter': 12,
+    'surpluscounter': 14,
+    'L1_voltage':     16,
+    'L2_voltage':     18,
+    'L3_voltage':     20,
+    'L1_signed_current': 22,
+    'L2_signed_current': 24,
+    'L3_signed_current': 26,
+    'frequency':      28,
+    'signed_power_factor': 30,
+}
+
+
+class Sink(object):
+    # subclasses implement send(snapshot) and optionally close()
+
+    def __init__(self, name, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = collections.deque(maxlen=queue_size)
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='sink-' + self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(1)
+        self.close()
+
+    def put(self, snapshot):
+        # deque.append is atomic, the deque drops the oldest snapshot by itself
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(snapshot)
+        self._wakeup.set()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue and self._running:
+                snapshot = self._queue.popleft()
+                try:
+                    self.send(snapshot)
+                    self.sent += 1
+                except Exception as e:
+                    # count the errors, only the first one is logged
+                    self.errors += 1
+                    if self.errors == 1:
+                        logger.warning('Sink %s could not send: %s' % (self.name, e))
+
+    def send(self, snapshot):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stats(self):
+        prefix = '/Mgmt/Stats/Sinks/' + self.name
+        return [
+            (prefix + '/Sent', self.sent),
+            (prefix + '/Dropped', self.dropped),
+            (prefix + '/Errors', self.errors),
+        ]
+
+
+class UdpJsonSink(Sink):
+    # one compact JSON datagram per snapshot, to a unicast or broadcast address
+
+    def __init__(self, host='127.0.0.1', port=9523, name='Udp', queue_size=QUEUE_SIZE):
+        Sink.__init__(self, name, queue_size)
+        self._address = (host, port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def send(self, snapshot):
+        self._sock.sendto(json.dumps(snapshot, separators=(',', ':')).encode(), self._address)
+
+    def close(self):
+        self._sock.close()
+
+
+class MqttSink(Sink):
+    # publishes the snapshot as JSON to <topic>/<serial>, with split=True every value to
+    # <topic>/<serial>/<name>. Needs paho-mqtt unless a client with publish(topic, payload) is given.
+
+    def __init__(self, host='localhost', port=1883, topic='smaem', split=False, client=None, name='Mqtt',
+                 queue_size=QUEUE_SIZE):
+        Sink.__init__(self, name, queue_size)
+        self._topic = topic
+        self._split = split
+        self._client = client
+        self._own_client = client is None
+        if client is None:
+            try:
+                import paho.mqtt.client as mqtt
+            except ImportError:
+                raise ImportError('the MQTT sink needs paho-mqtt (pip3 install paho-mqtt)')
+            if hasattr(mqtt, 'CallbackAPIVersion'):
+                self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            else:
+                self._client = mqtt.Client()
+            # the paho network loop reconnects in its own thread
+            self._client.connect_async(host, port)
+            self._client.loop_start()
+
+    def send(self, snapshot):
+        topic = '%s/%d' % (self._topic, snapshot['serial'])
+        if self._split:
+            for name, value in snapshot['values'].items():
+                self._publish(topic + '/' + name, json.dumps(value))
+        else:
+            self._publish(topic, json.dumps(snapshot, separators=(',', ':')))
+
+    def _publish(self, topic, payload):
+        # paho does not raise, it returns an error code, e.g. MQTT_ERR_NO_CONN while the broker is down
+        rc = getattr(self._client.publish(topic, payload), 'rc', 0)
+        if rc:
+            raise OSError('MQTT publish to %s failed with error %d' % (topic, rc))
+
+    def close(self):
+        if self._own_client:
+            self._client.loop_stop()
+            self._client.disconnect()
+
+
+class ModbusTcpSink(Sink):
+    # Modbus-TCP server with the latest values of one meter (serial None: any meter) as float32
+    # registers, the unit id of a request is ignored
+
+    def __init__(self, host='', port=5020, registers=DEFAULT_REGISTERS, serial=None, name='Modbus',
+                 queue_size=QUEUE_SIZE):
+        Sink.__init__(self, name, queue_size)
+        self._registers = registers
+        self._serial = serial
+        self._lock = threading.Lock()
+        self._image = bytearray(2 * (max(registers.values()) + 2))
+        self.requests = 0
+
+        sink = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sink._serve(self.request)
+
+        self._server = _TcpServer((host, port), Handler)
+        self.address = self._server.server_address
+
+    def start(self):
+        Sink.start(self)
+        threading.Thread(target=self._server.serve_forever, name='sink-%s-server' % self.name, daemon=True).start()
+
+    def send(self, snapshot):
+        if self._serial is not None and snapshot['serial'] != self._serial:
+            return
+        values = snapshot['values']
+        with self._lock:
+            for name, register in self._registers.items():
+                if name in values:
+                    struct.pack_into('>f', self._image, 2 * register, values[name])
+
+    def _serve(self, sock):
+        while True:
+            header = _receive(sock, 7)
+            if header is None:
+                return
+            transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = _receive(sock, length - 1) if length > 1 else None
+            if pdu is None or protocol != 0:
+                return
+
+            self.requests += 1
+            function = pdu[0]
+            if function not in (3, 4):
+                response = bytes((function | 0x80, 1))
+            elif len(pdu) < 5:
+                response = bytes((function | 0x80, 3))
+            else:
+                start, count = struct.unpack('>HH', pdu[1:5])
+                if not 1 <= count <= 125:
+                    response = bytes((function | 0x80, 3))
+                elif 2 * (start + count) > len(self._image):
+                    response = bytes((function | 0x80, 2))
+                else:
+                    with self._lock:
+                        data = bytes(self._image[2 * start:2 * (start + count)])
+                    response = bytes((function, len(data))) + data
+
+            sock.sendall(struct.pack('>HHHB', transaction, 0, len(response) + 1, unit) + response)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _TcpServer(socketserver.ThreadingTCPServer):
+    # the port can be bound again right after a restart of the service
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def _receive(sock, size):
+    # exactly size bytes, None if the connection is closed
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+SINK_TYPES = {
+    'udp': UdpJsonSink,
+    'mqtt': MqttSink,
+    'modbus': ModbusTcpSink,
+}
+
+
+def create_sinks(config):
+    # config: list of dicts with 'type' and the keyword arguments of the sink class. A sink which
+    # cannot be created (port in use, paho-mqtt missing) is logged and left out, the others and
+    # dbus keep running.
+    sinks = []
+    for options in config:
+        options = dict(options)
+        kind = options.pop('type', None)
+        try:
+            sinks.append(SINK_TYPES[kind](**options))
+        except Exception as e:
+            logger.error('Could not create %s sink: %s' % (options.get('name', kind), e))
+    return sinks
@@ -0,0 +1,200 @@
+# SMA Speedwire decoder
+#
+# Shared by dbus-sma-smartmeter.py and speedwire_test.py.
+#
+# The first datagram of every meter layout (SUSy-ID, serial and datagram length) is walked
+# OBIS by OBIS like the original loop did. The positions of all mapped channels are compiled
+# into one struct.Struct, so every following datagram of the same layout is decoded with a
+# single unpack_from. The OBIS ids are unpacked together with the values and compared against
+# the compiled plan; if the meter changes its layout the TLV walk runs again.
+#
+# The channel map is loaded from obis.json. Every channel gets a converter with its factor and
+# rounding precomputed, channels which are not in the map are skipped by pad bytes of the plan.
+
+import json
+import os
+import struct
+
+SMA_MAGIC = b'SMA'
+# datagrams of the energy meter protocol are always longer than this
+MIN_LENGTH = 100
+# protocol id of the energy meter protocol, e.g. inverters send 0x6065 to the same group
+PROTOCOL_ID = 0x6069
+# first OBIS value after the header
+OBIS_START = 28
+# limit the number of cached layouts, e.g. if some other SMA device sends varying lengths
+MAX_PLANS = 32
+
+# magic 'SMA' at 0, protocol id at 16, SUSy-ID at 18, serial at 20
+_HEADER = struct.Struct('>3s13xHHI')
+_OBIS = struct.Struct('>I')
+_VALUE_CODES = {4: 'I', 8: 'Q'}
+
+DEFAULT_CHANNELS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obis.json')
+
+def make_converter(factor, digits=2):
+    # raw integer value -> final value
+    if factor == 1:
+        return int
+    return lambda raw: round(raw * factor, digits)
+
+
+def load_channels(filename=DEFAULT_CHANNELS_FILE):
+    # returns the obis points of all enabled channels of the channel map
+    with open(filename) as f:
+        table = json.load(f)
+
+    obis_points = {}
+    for channel in table['channels']:
+        if not channel.get('enabled', True):
+            continue
+
+        length = channel['length']
+        if length not in _VALUE_CODES:
+            raise ValueError('%s: only OBIS message length of 4 or 8 is supported, %s has %d' % (filename, channel['name'], length))
+
+        factor = 1 / channel.get('divisor', 1)
+        obis_points[int(channel['obis'], 16)] = {
+            'name': channel['name'],
+            'length': length,
+            'factor': factor,
+            'unit': channel.get('unit', ''),
+            'value': 0,
+            'path': channel.get('path', ''),
+            # only decoded for these SUSy-IDs, empty for all devices
+            'susy': tuple(channel.get('susy', ())),
+            'convert': make_converter(factor, channel.get('digits', 2)),
+        }
+
+    return obis_points
+
+
+def parse_header(data):
+    # returns (SUSy-ID, serial) or None if the datagram is not an energy meter datagram
+    if len(data) <= MIN_LENGTH:
+        return None
+
+    magic, protocol_id, susy_id, serial = _HEADER.unpack_from(data)
+    if magic != SMA_MAGIC or protocol_id != PROTOCOL_ID:
+        return None
+
+    return susy_id, serial
+
+
+class SpeedwireDecoder(object):
+
+    def __init__(self, obis_points):
+        self._obis_points = obis_points
+        self._plans = {}
+        self._last_plan = None
+
+        # direct index for the regular OBIS ids 00 cc 04|08 00, a dict for all others
+        self._index = [None] * 512
+        self._other = {}
+        for obis_num, point in obis_points.items():
+            if obis_num & 0xFF0000FF == 0 and (obis_num >> 8) & 0xFF in _VALUE_CODES:
+                self._index[(obis_num >> 15) & 0x1FE | ((obis_num >> 11) & 1)] = point
+            else:
+                self._other[obis_num] = point
+
+    def _lookup(self, obis_num):
+        if obis_num & 0xFF0000FF == 0 and (obis_num >> 8) & 0xFF in _VALUE_CODES:
+            return self._index[(obis_num >> 15) & 0x1FE | ((obis_num >> 11) & 1)]
+        return self._other.get(obis_num)
+
+    def decode(self, data, susy_id, serial):
+        # writes the converted values of all mapped channels into obis_points
+        data = memoryview(data)
+        key = (susy_id, serial, len(data))
+
+        plan = self._plans.get(key)
+        if plan is not None:
+            raw = plan.layout.unpack_from(data)
+            if raw[0::2] != plan.ids:
+                # layout changed, walk the datagram again
+                plan = None
+
+        if plan is None:
+            plan = self._compile(data, susy_id)
+            if len(self._plans) >= MAX_PLANS:
+                self._plans.clear()
+            self._plans[key] = plan
+            raw = plan.layout.unpack_from(data)
+
+        values = raw[1::2]
+        if plan is self._last_plan:
+            # only convert channels which changed since the last datagram of this layout
+            last = plan.last
+            for i, value in enumerate(values):
+                if value != last[i]:
+                    plan.points[i]['value'] = plan.converters[i](value)
+        else:
+            for point, convert, value in zip(plan.points, plan.converters, values):
+                point['value'] = convert(value)
+
+        plan.last = values
+        self._last_plan = plan
+
+    def _compile(self, data, susy_id):
+        # walk the OBIS values the same way the original loop did and remember the positions
+        arrlen = len(data)
+        fmt = ['>']
+        ids = []
+        points = []
+        end = 0
+        pos = OBIS_START
+
+        while pos + 4 <= arrlen:
+
+            # Get obis value as 32 bit number
+            obis_num = _OBIS.unpack_from(data, pos)[0]
+            point = self._lookup(obis_num)
+            if point is not None and point.get('susy') and susy_id not in point['susy']:
+                point = None
+
+            if point is None:
+
+                # check for end of message
+                if obis_num == 0 and pos == arrlen - 4:
+                    break
+
+                # Extract length from obis number, second byte is the length
+                offset = data[pos + 2]
+
+                # Only 4 or 8 is allowed for offset since all known OBIS values have the length 4 or 8
+                # Add 4 for the OBIS value itself.
+                if offset == 4 or offset == 8:
+                    pos += offset + 4
+                else:
+                    pos += 4 + 4
+
+                continue
+
+            length = point['length']
+
+            # truncated datagram
+            if pos + 4 + length > arrlen:
+                break
+
+            if pos > end:
+                fmt.append('%dx' % (pos - end))
+            fmt.append('I' + _VALUE_CODES[length])
+            ids.append(obis_num)
+            points.append(point)
+
+            # Set read address to next obis value
+            pos += 4 + length
+            end = pos
+
+        return _Plan(struct.Struct(''.join(fmt)), tuple(ids), points)
+
+
+class _Plan(object):
+    __slots__ = ('layout', 'ids', 'points', 'converters', 'last')
+
+    def __init__(self, layout, ids, points):
+        self.layout = layout
+        self.ids = ids
+        self.points = points
+        self.converters = [point.get('convert') or make_converter(point['factor']) for point in points]
+        self.last = None
@@ -0,0 +1,129 @@
+# SMA Speedwire decoder micro-benchmark
+#
+# Compares the precompiled decoder from speedwire.py against the original OBIS loop.
+# Without arguments a synthetic SMA-EM10 datagram sequence is used, alternatively pass a file
+# with recorded datagrams: a capture file of speedwire_test.py --record or one hex encoded
+# datagram per line.
+#
+#   python3 speedwire_bench.py [--frames FILE] [--rounds N]
+
+import argparse
+import copy
+import struct
+import time
+
+from speedwire import SpeedwireDecoder, parse_header, load_channels
+from capture import is_capture, read_capture
+
+obis_points = load_channels()
+
+
+def legacy_decode(data, points):
+    # the OBIS loop as it was used in dbus-sma-smartmeter.py before speedwire.py
+    arrlen = len(data)
+
+    sma = str(data[0:3], 'ascii')
+    if sma == 'SMA' and arrlen > 100:
+
+        pos = 28
+
+        while (pos < arrlen):
+
+            obis_num = int.from_bytes(data[pos: pos + 4], 'big')
+
+            if obis_num not in points:
+
+                if obis_num == 0 and pos == arrlen - 4:
+                    break
+
+                offset = int.from_bytes(data[pos + 2: pos + 3], 'big')
+
+                if offset == 4 or offset == 8:
+                    pos += offset + 4
+                else:
+                    pos += 4 + 4
+
+                continue
+
+            length = points[obis_num]['length']
+            pos += 4
+
+            val = int.from_bytes(data[pos: pos + length], 'big')
+            points[obis_num]['value'] = round(val * points[obis_num]['factor'], 2)
+
+            pos += length
+
+
+def speedwire_decode(decoder, data):
+    header = parse_header(data)
+    if header is not None:
+        decoder.decode(data, header[0], header[1])
+
+
+def synthetic_frames(count, susy_id=270, serial=1900000001):
+    # SMA-EM10 channel layout: totals and per phase active, reactive and apparent power with
+    # their counters, power factor, current and voltage, software version and end marker
+    frames = []
+    for n in range(count):
+        obis = b''
+        for phase in (0, 20, 40, 60):
+            for channel in (1, 2, 3, 4, 9, 10):
+                obis += struct.pack('>IIIQ', (phase + channel) << 16 | 0x0400, 2000 + n % 50 * 13 + channel,
+                                    (phase + channel) << 16 | 0x0800, 21096000000 + n * 73)
+            if phase == 0:
+                obis += struct.pack('>II', 13 << 16 | 0x0400, 987) + struct.pack('>II', 14 << 16 | 0x0400, 50012)
+            else:
+                obis += struct.pack('>II', (phase + 11) << 16 | 0x0400, 1234 + n % 7)
+                obis += struct.pack('>II', (phase + 12) << 16 | 0x0400, 230000 + n % 11 * 17)
+                obis += struct.pack('>II', (phase + 13) << 16 | 0x0400, 990)
+        obis += struct.pack('>II', 0x90000000, 0x02030452) + struct.pack('>I', 0)
+        frames.append(b'SMA\x00\x00\x04\x02\xa0\x00\x00\x00\x01' + struct.pack('>HHH', len(obis) + 12, 0x0010, 0x6069)
+                      + struct.pack('>HII', susy_id, serial, n * 1000) + obis)
+    return frames
+
+
+def load_frames(filename):
+    if is_capture(filename):
+        return [data for timestamp, data in read_capture(filename)]
+    with open(filename) as f:
+        return [bytes.fromhex(line.strip()) for line in f if line.strip()]
+
+
+def run(name, function, frames, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for data in frames:
+            function(data)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(frames)
+    print('%-10s %8d frames %8.3f s %8.2f us/frame' % (name, count, elapsed, elapsed / count * 1e6))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speedwire decoder micro-benchmark')
+    parser.add_argument('--frames', help='capture file or file with one hex encoded datagram per line')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames) if args.frames else synthetic_frames(50)
+
+    legacy_points = copy.deepcopy(obis_points)
+    decoder_points = copy.deepcopy(obis_points)
+    decoder = SpeedwireDecoder(decoder_points)
+
+    # both decoders have to produce the same values
+    for data in frames:
+        legacy_decode(data, legacy_points)
+        speedwire_decode(decoder, data)
+        for obis_num, point in legacy_points.items():
+            if point['value'] != decoder_points[obis_num]['value']:
+                raise SystemExit('mismatch on %s: %s != %s' % (point['name'], point['value'], decoder_points[obis_num]['value']))
+
+    legacy = run('legacy', lambda data: legacy_decode(data, legacy_points), frames, args.rounds)
+    compiled = run('speedwire', lambda data: speedwire_decode(decoder, data), frames, args.rounds)
+    print('speedup    %.1fx' % (legacy / compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# SMA Speedwire load test
+#
+# Runs speedwire_sim.py in a second process for every combination of meter count and rate,
+# receives its datagrams from the multicast group on the loopback interface and feeds them into
+# the dbus service (against the stub of speedwire_replay.py) or with --decoder only into the
+# decoder. Reports the CPU time per frame, the datagrams dropped on the way, the end-to-end latency
+# from the send time in the datagram to the end of its decode and publish and, for comparison, the
+# latency to the receive time stamp of the kernel, all in us.
+#
+#   python3 speedwire_load.py [--meters 1,4,16] [--rates 1,10] [--duration 10] [--decoder]
+#
+# The default group and port (the one of speedwire_sim.py) differ from the ones of the meters, so
+# a service running on the same device does not receive the simulated meters.
+
+import argparse
+import multiprocessing
+import select
+import struct
+import time
+
+from speedwire import parse_header
+from speedwire_sim import Simulator, create_meters, MULTICAST_PORT, SEND_TIME_OBIS, SEND_TIME_OFFSET
+from speedwire_replay import DecoderTarget, ServiceTarget, percentile
+from stats import ReceiverStats
+import multicast
+
+MULTICAST_IP = "239.12.255.253"
+
+
+def _send(meters, rate, loss, duration, group, port, interface, results):
+    simulator = Simulator(create_meters(meters), rate, loss, group, port, interface)
+    simulator.run(duration)
+    simulator.close()
+    results.put((simulator.sent, simulator.lost, simulator.late))
+
+
+def run(target, meters, rate, args):
+    config = multicast.load_config(args.socket_config, {
+        'group': args.group, 'port': args.port, 'interface': args.interface, 'rcvbuf': args.rcvbuf})
+    sock = multicast.open_socket(config)
+    sock.setblocking(False)
+    stats = ReceiverStats()
+    reader = multicast.BatchReader(sock, config, stats)
+    results = multiprocessing.Queue()
+    sender = multiprocessing.Process(target=_send, args=(
+        meters, rate, args.loss, args.duration, args.group, args.port, args.interface, results))
+
+    received = 0
+    latencies = []
+    kernel_latencies = []
+
+    cpu = time.process_time()
+    sender.start()
+    while True:
+        if not select.select([sock], [], [], 0.5)[0]:
+            if not sender.is_alive():
+                break
+            continue
+        datagrams = reader.read()
+
+        for data, address, timestamp in datagrams:
+            data = bytes(data)
+            if parse_header(data) is None:
+                continue
+            target(data, timestamp)
+            done = time.time()
+            received += 1
+            # send time of the simulator in us, both clocks are the wall clock of this host
+            obis, sent = struct.unpack_from('>IQ', data, len(data) - SEND_TIME_OFFSET - 4)
+            if obis == SEND_TIME_OBIS:
+                latencies.append(int(done * 1e6) - sent)
+                kernel_latencies.append(int(timestamp * 1e6) - sent)
+    cpu = time.process_time() - cpu
+
+    sender.join()
+    sock.close()
+    sent, lost, late = results.get()
+    latencies.sort()
+    kernel_latencies.sort()
+    return {
+        'meters': meters,
+        'rate': rate,
+        'sent': sent,
+        'received': received,
+        'lost': lost,
+        'dropped': stats.dropped,
+        'missing': sent - received,
+        'late': late,
+        'cpu': cpu / received * 1e6 if received else 0,
+        'load': cpu / args.duration * 100,
+        'p50': percentile(latencies, 50) if latencies else 0,
+        'p99': percentile(latencies, 99) if latencies else 0,
+        'max': latencies[-1] if latencies else 0,
+        'kernel_p50': percentile(kernel_latencies, 50) if kernel_latencies else 0,
+        'kernel_p99': percentile(kernel_latencies, 99) if kernel_latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the Speedwire receive path')
+    parser.add_argument('--meters', default='1,4,16', help='comma separated numbers of meters')
+    parser.add_argument('--rates', default='1,10', help='comma separated datagram rates per meter in Hz')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per combination')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of datagrams the simulator does not send')
+    parser.add_argument('--decoder', action='store_true', help='feed the decoder instead of the dbus service')
+    parser.add_argument('--group', default=MULTICAST_IP, help='multicast group')
+    parser.add_argument('--port', type=int, default=MULTICAST_PORT, help='UDP port')
+    parser.add_argument('--interface', default='127.0.0.1', help='address of the interface')
+    parser.add_argument('--rcvbuf', type=int, help='socket receive buffer in bytes')
+    parser.add_argument('--socket-config', metavar='FILE', help='socket settings (JSON) of multicast.py')
+    args = parser.parse_args()
+
+    print('%6s %6s %8s %8s %6s %7s %7s %5s %10s %6s %-22s %s' % (
+        'meters', 'rate', 'sent', 'received', 'lost', 'dropped', 'missing', 'late', 'cpu/frame', 'load',
+        'latency p50/p99/max', 'kernel p50/p99'))
+    for meters in [int(n) for n in args.meters.split(',')]:
+        for rate in [float(r) for r in args.rates.split(',')]:
+            # a new service for every run, so the meters are discovered again
+            target = DecoderTarget() if args.decoder else ServiceTarget(auto_discovery=True)
+            result = run(target, meters, rate, args)
+            print('%(meters)6d %(rate)6g %(sent)8d %(received)8d %(lost)6d %(dropped)7d %(missing)7d %(late)5d '
+                  '%(cpu)7.1f us %(load)5.1f%% %(latency)-22s %(kernel_p50)d/%(kernel_p99)d us' % dict(
+                      result, latency='%(p50)d/%(p99)d/%(max)d us' % result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# SMA Speedwire replay
+#
+# Feeds a capture file (speedwire_test.py --record or RECORD_FILE of the service) into the
+# decoder or into the dbus service and reports frames per second and per frame latency.
+# The dbus service runs against a stub instead of VeDbusService, so nothing is published, but
+# its module still needs the GLib and dbus python bindings of Venus OS. There is no main loop,
+# its timers (publish scheduler, statistics) run by the time stamps of the datagrams instead.
+#
+#   python3 speedwire_replay.py FILE [--speed N | --fast] [--service] [--repeat N]
+
+import argparse
+import importlib.util
+import os
+import time
+
+from speedwire import SpeedwireDecoder, parse_header, load_channels
+from capture import read_capture
+
+
+class StubDbusService(object):
+    # stands in for VeDbusService and counts what would have been sent
+    def __init__(self, servicename, bus=None, register=True):
+        self.servicename = servicename
+        self.values = {}
+        self.signals = 0
+        self.items = 0
+
+    def add_path(self, path, value, description='', writeable=False, onchangecallback=None, gettextcallback=None, **kwargs):
+        self.values[path] = value
+
+    def register(self):
+        pass
+
+    def __getitem__(self, path):
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        self.values[path] = value
+        self.signals += 1
+        self.items += 1
+
+    def __delitem__(self, path):
+        del self.values[path]
+
+    def __enter__(self):
+        return _StubContext(self)
+
+    def __exit__(self, *exc):
+        self.signals += 1
+
+
+class _StubContext(object):
+    def __init__(self, service):
+        self._service = service
+
+    def __getitem__(self, path):
+        return self._service.values[path]
+
+    def __setitem__(self, path, value):
+        self._service.values[path] = value
+        self._service.items += 1
+
+
+class SimulatedTimers(object):
+    # stands in for GLib in the modules of the service, timeouts run when advance() reaches them,
+    # everything else is passed to GLib
+    def __init__(self, glib):
+        self._glib = glib
+        self._timers = []
+        self.now = None
+
+    def __getattr__(self, name):
+        return getattr(self._glib, name)
+
+    def timeout_add(self, interval, callback, *args):
+        self._add(interval / 1000, callback, args)
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        self._add(interval, callback, args)
+
+    def _add(self, interval, callback, args):
+        # [due, interval, callback, args], timers added before the first datagram start with it
+        due = self.now + interval if self.now is not None else None
+        self._timers.append([due, interval, callback, args])
+
+    def advance(self, now):
+        if self.now is None:
+            for timer in self._timers:
+                timer[0] = now + timer[1]
+        # the time never runs backwards, e.g. for datagrams of several meters read in one batch
+        self.now = now = max(now, self.now or now)
+
+        while self._timers:
+            timer = min(self._timers, key=lambda timer: timer[0])
+            if timer[0] > now:
+                break
+            if timer[2](*timer[3]):
+                timer[0] += timer[1]
+            else:
+                self._timers.remove(timer)
+
+
+class DecoderTarget(object):
+    def __init__(self):
+        self._decoders = {}
+
+    def __call__(self, data, timestamp=None):
+        header = parse_header(data)
+        if header is None:
+            return
+        decoder = self._decoders.get(header[1])
+        if decoder is None:
+            decoder = self._decoders[header[1]] = SpeedwireDecoder(load_channels())
+        decoder.decode(data, header[0], header[1])
+
+    def report(self):
+        print('meters     %d' % len(self._decoders))
+
+
+class ServiceTarget(object):
+    def __init__(self, auto_discovery=False):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dbus-sma-smartmeter.py')
+        spec = importlib.util.spec_from_file_location('dbus_sma_smartmeter', path)
+        self._module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self._module)
+        # like the service module only imported here, it needs GLib
+        import scheduler
+        self._module.VeDbusService = StubDbusService
+        self._module.dbusconnection = lambda: None
+        self._module.AUTO_DISCOVERY = auto_discovery
+        self._timers = SimulatedTimers(self._module.GLib)
+        self._module.GLib = scheduler.GLib = self._timers
+        self._dispatcher = self._module.MeterDispatcher()
+
+    def __call__(self, data, timestamp=None):
+        # timestamp in seconds drives the timers, the time of the call if None
+        self._timers.advance(time.monotonic() if timestamp is None else timestamp)
+        header = parse_header(data)
+        if header is not None:
+            self._dispatcher.dispatch(header[1], data)
+
+    def report(self):
+        services = [service for service in self._dispatcher._services.values() if service is not None]
+        for service in set(services):
+            stub = service._dbusservice
+            print('%-40s %8d signals %8d items' % (stub.servicename, stub.signals, stub.items))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def replay(frames, target, speed, offset=0):
+    # offset is added to the time stamps of the capture, so a repeated capture continues in time
+    latencies = []
+    start = time.perf_counter()
+    first = frames[0][0]
+
+    for timestamp, data in frames:
+        if speed:
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        t = time.perf_counter()
+        target(data, timestamp + offset)
+        latencies.append(time.perf_counter() - t)
+
+    return time.perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a Speedwire capture file')
+    parser.add_argument('file', help='capture file')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 1 is real time')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible')
+    parser.add_argument('--service', action='store_true', help='feed DbusSMAEMService._update instead of the decoder')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the capture N times')
+    args = parser.parse_args()
+
+    frames = list(read_capture(args.file))
+    if not frames:
+        raise SystemExit('%s contains no datagrams' % args.file)
+
+    target = ServiceTarget() if args.service else DecoderTarget()
+    speed = 0 if args.fast else args.speed
+
+    elapsed = 0
+    latencies = []
+    # one second between the end of the capture and its repetition
+    span = frames[-1][0] - frames[0][0] + 1
+    for n in range(args.repeat):
+        duration, frame_latencies = replay(frames, target, speed, n * span)
+        elapsed += duration
+        latencies.extend(frame_latencies)
+
+    busy = sum(latencies)
+    latencies.sort()
+    print('frames     %d in %.3f s, %.1f frames/s (%.1f frames/s busy)' % (len(latencies), elapsed, len(latencies) / elapsed, len(latencies) / busy))
+    print('latency    p50 %.1f us, p90 %.1f us, p99 %.1f us, max %.1f us' % (
+        percentile(latencies, 50) * 1e6, percentile(latencies, 90) * 1e6, percentile(latencies, 99) * 1e6, latencies[-1] * 1e6))
+    target.report()
+
+
+if __name__ == "__main__":
+    main()
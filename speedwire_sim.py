@@ -0,0 +1,222 @@
+# SMA Speedwire simulator
+#
+# Sends datagrams of simulated SMA-EM10, SMA-EM20 and SHM2.0 meters to a multicast group, by
+# default on the loopback interface, so the service can be tested without hardware:
+#
+#   python3 speedwire_sim.py --meters 4 --rate 10 --loss 0.01
+#   python3 dbus-sma-smartmeter.py --interface 127.0.0.1 --port 9524
+#
+# The default port is not the one of the meters, so a service on the same device only receives
+# the simulated meters if it is started with --port.
+#
+# Every meter has three phases with a house load, a PV system which produces in a compressed
+# day of --day seconds and energy counters which integrate the power. The last channel before
+# the end marker, SEND_TIME_OBIS, is not sent by SMA meters and carries the wall clock time of
+# the sender in us, speedwire_load.py uses it to measure the latency.
+
+import argparse
+import math
+import random
+import socket
+import struct
+import time
+
+MULTICAST_IP = "239.12.255.254"
+# not the Speedwire port 9522, see above
+MULTICAST_PORT = 9524
+
+# model -> (SUSy-ID, software version as sent in OBIS 0x90000000)
+MODELS = {
+    'EM10':   (270, 0x02030452),
+    'EM20':   (349, 0x02010452),
+    'SHM2.0': (372, 0x020D0652),
+}
+
+# channel numbers of the OBIS ids, the phases are 20 channels apart
+_POWER_CHANNELS = (1, 2, 3, 4, 9, 10)
+_PHASE_OFFSETS = (20, 40, 60)
+_END_MARKER = 0
+# unused channel with the send time in us since the epoch, the decoder skips it
+SEND_TIME_OBIS = 0x00FF0800
+# offset of the send time from the end of the datagram
+SEND_TIME_OFFSET = 12
+
+
+def _obis(channel, length):
+    return channel << 16 | length << 8
+
+
+class SimulatedMeter(object):
+
+    def __init__(self, model, serial, seed=None, day=600):
+        self.model = model
+        self.serial = serial
+        self.susy_id, self._version = MODELS[model]
+        self._random = random.Random(seed if seed is not None else serial)
+        self._day = day
+        self._pv_peak = self._random.choice((0, 4000, 6000, 9000))
+        self._load = [self._random.uniform(100, 400) for _ in _PHASE_OFFSETS]
+        # counters in Ws per channel, start somewhere in the life of the meter
+        self._counters = {}
+        for offset in (0,) + _PHASE_OFFSETS:
+            for channel in _POWER_CHANNELS:
+                self._counters[offset + channel] = self._random.uniform(1e9, 5e10)
+        self._last = None
+
+        # one struct for the whole datagram, OBIS ids and values alternate
+        layout = '>4sIIHHHHII'
+        self._ids = []
+        for offset in (0,) + _PHASE_OFFSETS:
+            for channel in _POWER_CHANNELS:
+                self._ids += [_obis(offset + channel, 4), _obis(offset + channel, 8)]
+                layout += 'IIIQ'
+            if offset == 0:
+                self._ids += [_obis(13, 4), _obis(14, 4)]
+                layout += 'IIII'
+            else:
+                self._ids += [_obis(offset + 11, 4), _obis(offset + 12, 4), _obis(offset + 13, 4)]
+                layout += 'IIIIII'
+        # software version, send time and end marker
+        layout += 'IIIQI'
+        self._struct = struct.Struct(layout)
+
+    def _phases(self, now):
+        # active and reactive power per phase in W and var, positive for import
+        pv = self._pv_peak * max(0.0, math.sin(2 * math.pi * now / self._day)) / 3
+        phases = []
+        for i in range(3):
+            # random walk of the load with an occasional kettle or washing machine
+            load = self._load[i] + self._random.gauss(0, 5)
+            if self._random.random() < 0.002:
+                load += self._random.choice((-1, 1)) * 2000
+            self._load[i] = load = min(max(load, 50), 7000)
+            phases.append((load - pv * self._random.uniform(0.98, 1.02), load * 0.25))
+        return phases
+
+    def datagram(self, now=None):
+        now = time.monotonic() if now is None else now
+        dt = now - self._last if self._last is not None else 0
+        self._last = now
+
+        values = []
+        powers = {}
+        frequency = 50 + 0.02 * math.sin(now / 7)
+        currents = []
+        voltages = []
+        factors = []
+        phases = self._phases(now)
+        for offset, (active, reactive) in zip(_PHASE_OFFSETS, phases):
+            apparent = math.hypot(active, reactive)
+            powers[offset] = (active, reactive, apparent)
+            voltage = 230 + 3 * math.sin(now / 13 + offset)
+            voltages.append(voltage)
+            currents.append(apparent / voltage)
+            factors.append(abs(active) / apparent if apparent else 1)
+        active, reactive = sum(p[0] for p in phases), sum(p[1] for p in phases)
+        apparent = sum(p[2] for p in powers.values())
+        powers[0] = (active, reactive, apparent)
+
+        for offset in (0,) + _PHASE_OFFSETS:
+            active, reactive, apparent = powers[offset]
+            # import and export channels of active, reactive and apparent power
+            for channel, power in zip(_POWER_CHANNELS, (max(active, 0), max(-active, 0), max(reactive, 0),
+                                                         max(-reactive, 0), apparent if active >= 0 else 0,
+                                                         apparent if active < 0 else 0)):
+                self._counters[offset + channel] += power * dt
+                values += [int(power * 10), int(self._counters[offset + channel])]
+            if offset == 0:
+                values += [int(abs(active) / apparent * 1000) if apparent else 1000, int(frequency * 1000)]
+            else:
+                i = _PHASE_OFFSETS.index(offset)
+                values += [int(currents[i] * 1000), int(voltages[i] * 1000), int(factors[i] * 1000)]
+
+        fields = []
+        for obis_id, value in zip(self._ids, values):
+            fields += [obis_id, value]
+        fields += [0x90000000, self._version, SEND_TIME_OBIS, int(time.time() * 1e6), _END_MARKER]
+
+        tick = int(now * 1000) & 0xFFFFFFFF
+        return self._struct.pack(b'SMA\x00', 0x000402a0, 0x00000001, self._struct.size - 16, 0x0010, 0x6069,
+                                 self.susy_id, self.serial, tick, *fields)
+
+
+def create_meters(count, model='mixed', serial=1900000001, day=600):
+    models = sorted(MODELS) if model == 'mixed' else [model]
+    return [SimulatedMeter(models[n % len(models)], serial + n, day=day) for n in range(count)]
+
+
+class Simulator(object):
+    # sends the datagrams of all meters, every meter in its own slot of the period
+
+    def __init__(self, meters, rate=1.0, loss=0.0, group=MULTICAST_IP, port=MULTICAST_PORT, interface='127.0.0.1'):
+        self._meters = meters
+        self._period = 1.0 / rate
+        self._loss = loss
+        self._address = (group, port)
+        self._random = random.Random(0)
+        self.sent = 0
+        self.lost = 0
+        self.late = 0
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface:
+            self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+
+    def run(self, duration=0):
+        start = time.monotonic()
+        slot = self._period / len(self._meters)
+        cycle = 0
+        while not duration or time.monotonic() - start < duration:
+            for n, meter in enumerate(self._meters):
+                due = start + cycle * self._period + n * slot
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -self._period:
+                    # the sender itself cannot keep up
+                    self.late += 1
+
+                data = meter.datagram()
+                if self._random.random() < self._loss:
+                    self.lost += 1
+                    continue
+                self._sock.sendto(data, self._address)
+                self.sent += 1
+            cycle += 1
+
+    def close(self):
+        self._sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send simulated SMA energy meter datagrams')
+    parser.add_argument('--meters', type=int, default=1, help='number of meters')
+    parser.add_argument('--model', default='mixed', choices=sorted(MODELS) + ['mixed'], help='meter model')
+    parser.add_argument('--serial', type=int, default=1900000001, help='serial of the first meter')
+    parser.add_argument('--rate', type=float, default=1.0, help='datagrams per second and meter')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of datagrams which are not sent')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to run, 0 runs until interrupted')
+    parser.add_argument('--day', type=float, default=600, help='length of a simulated PV day in seconds')
+    parser.add_argument('--group', default=MULTICAST_IP, help='multicast group')
+    parser.add_argument('--port', type=int, default=MULTICAST_PORT, help='UDP port')
+    parser.add_argument('--interface', default='127.0.0.1', help='address of the sending interface')
+    args = parser.parse_args()
+
+    meters = create_meters(args.meters, args.model, args.serial, args.day)
+    for meter in meters:
+        print('%-7s serial %d SUSy-ID %d' % (meter.model, meter.serial, meter.susy_id))
+
+    simulator = Simulator(meters, args.rate, args.loss, args.group, args.port, args.interface)
+    try:
+        simulator.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+    print('sent %d, lost %d, late %d' % (simulator.sent, simulator.lost, simulator.late))
+
+
+if __name__ == "__main__":
+    main()
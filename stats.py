@@ -0,0 +1,156 @@
+# Hot path statistics
+#
+# Plain counters and fixed bucket histograms which are cheap enough to be updated for every
+# datagram. They are published below /Mgmt/Stats by a timer, never from the hot path itself.
+
+import os
+import time
+from bisect import bisect_left
+
+# upper bounds of the histogram buckets in microseconds, the last bucket takes everything above
+TIME_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+# upper bounds of the histogram buckets for datagram gaps in milliseconds
+GAP_BUCKETS = (50, 100, 150, 200, 300, 500, 800, 1000, 1200, 1500, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, p):
+        # upper bound of the bucket which contains the percentile, limited to the maximum
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self._buckets[i], self.max) if i < len(self._buckets) else self.max
+        return self.max
+
+    def summary(self, prefix):
+        return [
+            (prefix + '/Mean', round(self.mean, 1)),
+            (prefix + '/P99', round(self.percentile(99), 1)),
+            (prefix + '/Max', round(self.max, 1)),
+        ]
+
+
+class ReceiverStats(object):
+    # shared by all meters, counts what happens on the socket before a datagram is dispatched
+
+    def __init__(self):
+        self.received = 0
+        self.accepted = 0
+        self.stale = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.reconnects = 0
+        self.recovery_time = 0
+        # dbus services of discovered meters which could not be created
+        self.service_errors = 0
+        self.rejected = {'Serial': 0, 'Short': 0, 'Header': 0, 'Source': 0}
+
+    def values(self):
+        values = [
+            ('/Mgmt/Stats/Received', self.received),
+            ('/Mgmt/Stats/Accepted', self.accepted),
+            ('/Mgmt/Stats/Stale', self.stale),
+            ('/Mgmt/Stats/Dropped', self.dropped),
+            ('/Mgmt/Stats/Truncated', self.truncated),
+            ('/Mgmt/Stats/Reconnects', self.reconnects),
+            ('/Mgmt/Stats/RecoveryTime', self.recovery_time),
+            ('/Mgmt/Stats/Errors/Service', self.service_errors),
+        ]
+        values.extend(('/Mgmt/Stats/Rejected/' + name, count) for name, count in self.rejected.items())
+        return values
+
+
+class ServiceStats(object):
+    # per meter timings in microseconds, gaps in milliseconds. The latency is measured from the
+    # receive time of the datagram to the end of the update.
+
+    def __init__(self):
+        self.frames = 0
+        self.errors = {'Decode': 0, 'Publish': 0}
+        self.decode_time = Histogram(TIME_BUCKETS)
+        self.publish_time = Histogram(TIME_BUCKETS)
+        self.gap = Histogram(GAP_BUCKETS)
+        self.latency = Histogram(TIME_BUCKETS)
+
+    def values(self):
+        values = [('/Mgmt/Stats/Frames', self.frames)]
+        values.extend(('/Mgmt/Stats/Errors/' + name, count) for name, count in self.errors.items())
+        values.extend(self.decode_time.summary('/Mgmt/Stats/DecodeTime'))
+        values.extend(self.publish_time.summary('/Mgmt/Stats/PublishTime'))
+        values.extend(self.gap.summary('/Mgmt/Stats/Gap'))
+        values.extend(self.latency.summary('/Mgmt/Stats/Latency'))
+        return values
+
+
+def process_age():
+    # seconds since the process was started, including the start of python, None if unknown
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupStats(object):
+    # durations of the startup phases and the time from the process start to the first published
+    # reading. The phases are fixed, their dbus paths exist before they are measured.
+    PHASES = ('Python', 'Imports', 'Setup', 'Services', 'Socket')
+
+    def __init__(self, started):
+        # started: monotonic time before the imports of the script
+        now = time.monotonic()
+        age = process_age()
+        self._process_start = now - age if age is not None and age > now - started else started
+        self.durations = {'Python': started - self._process_start}
+        self._last = started
+        self.first_reading = None
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.durations[phase] = now - self._last
+        self._last = now
+
+    def reading(self):
+        # True for the first published reading of the process
+        if self.first_reading is not None:
+            return False
+        self.first_reading = time.monotonic() - self._process_start
+        return True
+
+    def summary(self):
+        text = ', '.join('%s %d ms' % (phase.lower(), round(self.durations[phase] * 1000))
+                         for phase in self.PHASES if phase in self.durations)
+        return text + ', first reading after %d ms' % round(self.first_reading * 1000)
+
+    def values(self):
+        # milliseconds, None if not measured (yet)
+        values = []
+        for phase in self.PHASES:
+            duration = self.durations.get(phase)
+            values.append(('/Mgmt/Stats/Startup/' + phase, round(duration * 1000) if duration is not None else None))
+        values.append(('/Mgmt/Stats/Startup/FirstReading', round(self.first_reading * 1000) if self.first_reading is not None else None))
+        return values